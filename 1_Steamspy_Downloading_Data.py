@@ -8,46 +8,485 @@ This file is about to download data from Steamspy API to .csv file.
 """
 
 #%% standard library imports
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import csv
 import datetime as dt
+from email.utils import parsedate_to_datetime
+import gzip
+import hashlib
 import json
 import os
+import random
+import shutil
 import statistics
+import threading
 import time
+from urllib.parse import parse_qsl, urlsplit
 
 #%% third-party imports
 import numpy as np
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+
+#%% local imports
+import metrics
+import storage
 
 #%% customisations - ensure tables show all columns
 pd.options.display.max_columns = 100
 
+#%% data file columns
+# fields written for every app, in this order, by the steam and steamspy parsers
+steam_columns = [
+'type', 'name', 'steam_appid', 'required_age', 'is_free', 'controller_support',
+'dlc', 'detailed_description', 'about_the_game', 'short_description', 'fullgame',
+'supported_languages', 'header_image', 'website', 'pc_requirements', 'mac_requirements',
+'linux_requirements', 'legal_notice', 'drm_notice', 'ext_user_account_notice',
+'developers', 'publishers', 'demos', 'price_overview', 'packages', 'package_groups',
+'platforms', 'metacritic', 'reviews', 'categories', 'genres', 'screenshots',
+'movies', 'recommendations', 'achievements', 'release_date', 'support_info',
+'background', 'content_descriptors']
+
+steamspy_columns = [
+'appid', 'name', 'developer', 'publisher', 'score_rank', 'positive',
+'negative', 'userscore', 'owners', 'average_forever', 'average_2weeks',
+'median_forever', 'median_2weeks', 'price', 'initialprice', 'discount',
+'languages', 'genre', 'ccu', 'tags']
+
+#%% api endpoints and rate limits
+# point these at a local stub server to test the downloader without hitting the real apis
+STEAM_URL = "http://store.steampowered.com/api/appdetails/"
+STEAMSPY_URL = "https://steamspy.com/api.php"
+
+# requests per second allowed for every host, hosts not listed here are not limited
+rate_limits = {
+    "store.steampowered.com": 200 / 300,
+    "steamspy.com": 1,
+    }
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+#%% http client settings
+# keep-alive connections kept per host, should be at least the download concurrency
+pool_size = 16
+request_timeout = 30
+
+# retry schedule: exponential backoff with full jitter, capped in time and in attempts
+max_attempts = 8
+backoff_base = 1
+backoff_cap = 60
+
+# optional requests proxies mapping, set per worker in sharded mode to spread load over egress ips
+proxies = None
+
+session = None
+session_pid = None
+session_lock = threading.Lock()
+
+# latency (seconds) and retry counts per endpoint, see print_request_stats
+request_stats = {}
+request_stats_lock = threading.Lock()
+
+#%% response cache settings
+# time to live in seconds for every endpoint, responses from endpoints not listed here are not cached
+cache_ttls = {
+    "store.steampowered.com/api/appdetails/": 30 * 24 * 3600,
+    "steamspy.com/api.php?request=appdetails": 7 * 24 * 3600,
+    "steamspy.com/api.php?request=all": 24 * 3600,
+    }
+
+# cache is off until configure_cache is called with a directory
+response_cache = {"path": None, "max_bytes": 20 * 1024**3, "compresslevel": 6, "size": 0, "lock": threading.Lock()}
+
+#%% rate limiting
+def make_token_bucket(rate, capacity=1):
+    return {"rate": rate, "capacity": capacity, "tokens": capacity,
+            "updated": time.monotonic(), "lock": threading.Lock()}
+
+def take_token(bucket):
+    # reserve a token under the lock and sleep outside of it, so waiting threads queue up fairly
+    with bucket["lock"]:
+        now = time.monotonic()
+        refill = (now - bucket["updated"]) * bucket["rate"]
+        bucket["tokens"] = min(bucket["capacity"], bucket["tokens"] + refill)
+        bucket["updated"] = now
+        bucket["tokens"] -= 1
+        wait = -bucket["tokens"] / bucket["rate"] if bucket["tokens"] < 0 else 0
+        
+    if wait > 0:
+        time.sleep(wait)
+        
+    return wait
+
+def get_rate_limiter(url_a):
+    host = urlsplit(url_a).hostname
+    
+    if host not in rate_limits:
+        return None
+    
+    with rate_limiters_lock:
+        if host not in rate_limiters:
+            rate_limiters[host] = make_token_bucket(rate_limits[host])
+            
+    return rate_limiters[host]
+
+#%% http client
+def get_session():
+    global session, session_pid
+    
+    # one pooled session per process, a session inherited from a parent process is not reused
+    with session_lock:
+        if session is None or session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            if proxies:
+                session.proxies.update(proxies)
+            session_pid = os.getpid()
+            
+    return session
+
+def get_backoff(attempt):
+    return random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+
+def get_retry_after(response):
+    value = response.headers.get("Retry-After")
+    
+    if value is None:
+        return None
+    
+    # header is either a number of seconds or a http date
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    
+    return max(0, (retry_at - dt.datetime.now(retry_at.tzinfo)).total_seconds())
+
+def record_request(url_a, parameters, latency, retries, status_429, failed=False):
+    # steamspy endpoints share a host but not their speed, so stats are kept per endpoint
+    endpoint, query = get_cache_endpoint(url_a, parameters)
+    
+    with request_stats_lock:
+        stats = request_stats.setdefault(endpoint, {"requests": 0, "retries": 0, "status_429": 0,
+                                                    "failures": 0, "latency": []})
+        stats["requests"] += 1
+        stats["retries"] += retries
+        stats["status_429"] += status_429
+        stats["failures"] += failed
+        
+        if latency is not None:
+            stats["latency"].append(latency)
+
+def print_request_stats():
+    with request_stats_lock:
+        for endpoint, stats in request_stats.items():
+            latency = stats["latency"]
+            
+            if latency:
+                p95 = np.percentile(latency, 95)
+                latency_info = "latency avg: {:.3f}s, median: {:.3f}s, p95: {:.3f}s".format(
+                    statistics.mean(latency), statistics.median(latency), p95)
+            else:
+                latency_info = "no latency data"
+                
+            print("{}: {} requests, {} retries, {} x 429, {} failed, {}".format(
+                endpoint, stats["requests"], stats["retries"], stats["status_429"], stats["failures"], latency_info))
+
+def get_request_report():
+    # request section of the metrics file, see metrics.py
+    with request_stats_lock:
+        return {endpoint: {"requests": stats["requests"], "retries": stats["retries"], "status_429": stats["status_429"],
+                           "failures": stats["failures"], "latency_s": metrics.summarize(stats["latency"]),
+                           "latency_histogram": metrics.histogram(stats["latency"])}
+                for endpoint, stats in request_stats.items()}
+
+metrics.register_report("requests", get_request_report)
+
+#%% response cache
+def configure_cache(cache_path, max_bytes=None, compresslevel=None):
+    os.makedirs(cache_path, exist_ok=True)
+    
+    with response_cache["lock"]:
+        response_cache["path"] = cache_path
+        
+        if max_bytes is not None:
+            response_cache["max_bytes"] = max_bytes
+        if compresslevel is not None:
+            response_cache["compresslevel"] = compresslevel
+            
+        response_cache["size"] = sum(os.path.getsize(path) for path, mtime in iter_cache_files(cache_path))
+        
+def iter_cache_files(cache_path):
+    for root, dirs, files in os.walk(cache_path):
+        for filename in files:
+            if filename.endswith(".json.gz"):
+                path = os.path.join(root, filename)
+                yield path, os.path.getmtime(path)
+    
+def get_cache_endpoint(url_a, parameters):
+    parts = urlsplit(url_a)
+    query = dict(parse_qsl(parts.query))
+    query.update({key: str(value) for key, value in (parameters or {}).items()})
+    
+    #steamspy serves everything from one path, its 'request' parameter tells the endpoints apart
+    endpoint = parts.hostname + parts.path
+    if "request" in query:
+        endpoint += "?request=" + query["request"]
+    
+    return endpoint, query
+
+def get_cache_path(url_a, parameters):
+    endpoint, query = get_cache_endpoint(url_a, parameters)
+    
+    if response_cache["path"] is None or endpoint not in cache_ttls:
+        return None, None
+    
+    #key covers endpoint and all parameters (appid, page, ...), sorted so their order does not matter
+    key = hashlib.sha256(json.dumps([endpoint, sorted(query.items())]).encode("utf-8")).hexdigest()
+    folder = endpoint.replace("/", "_").replace("?", "_").replace("=", "_")
+    
+    return os.path.join(response_cache["path"], folder, key[:2], key + ".json.gz"), cache_ttls[endpoint]
+
+def read_cache(url_a, parameters=None):
+    path, ttl = get_cache_path(url_a, parameters)
+    
+    if path is None:
+        return None
+    
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (FileNotFoundError, EOFError, OSError, ValueError):
+        return None
+    
+    if time.time() - entry["created"] > ttl:
+        return None
+    
+    #file modification time doubles as last access time for lru eviction, another thread may have evicted
+    #the entry since it was read, the data is still good
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    
+    return entry["data"]
+
+def write_cache(url_a, parameters, json_data):
+    path, ttl = get_cache_path(url_a, parameters)
+    
+    if path is None:
+        return
+    
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    
+    with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=response_cache["compresslevel"]) as f:
+        json.dump({"created": time.time(), "url": url_a, "data": json_data}, f)
+        
+    size = os.path.getsize(tmp_path)
+    
+    #an entry written again (expired or refreshed) replaces the old file, only the difference is added
+    with response_cache["lock"]:
+        try:
+            size -= os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+        response_cache["size"] += size
+        
+        if response_cache["size"] > response_cache["max_bytes"]:
+            evict_cache()
+            
+def evict_cache():
+    #drop least recently used entries down to 90% of the cap, so eviction does not run on every write
+    target = response_cache["max_bytes"] * 0.9
+    entries = sorted(iter_cache_files(response_cache["path"]), key=lambda entry: entry[1])
+    size = sum(os.path.getsize(path) for path, mtime in entries)
+    
+    for path, mtime in entries:
+        if size <= target:
+            break
+        
+        try:
+            file_size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        
+        size -= file_size
+        
+    response_cache["size"] = size
+
+#%% checkpoint journal
+def append_checkpoint(download_path, journal_filename, checkpoint):
+    rel_path = os.path.join(download_path, journal_filename)
+    line = json.dumps(checkpoint).encode("utf-8") + b"\n"
+    
+    with open(rel_path, "a+b") as f:
+        #start on a fresh line if the previous append was torn by a crash
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                line = b"\n" + line
+                
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+        
+def read_checkpoint(download_path, journal_filename):
+    rel_path = os.path.join(download_path, journal_filename)
+    
+    try:
+        f = open(rel_path, "rb")
+    except FileNotFoundError:
+        return None
+    
+    #read backwards from the end until the last complete line, so resume cost does not grow with the journal
+    with f:
+        end = f.seek(0, os.SEEK_END)
+        chunk = 4096
+        
+        while True:
+            start = max(0, end - chunk)
+            f.seek(start)
+            lines = f.read(end - start).splitlines()
+            
+            #first line of a chunk may be cut in half unless the chunk starts the file
+            if start > 0:
+                lines = lines[1:]
+                
+            for line in reversed(lines):
+                try:
+                    return json.loads(line)
+                except ValueError:
+                    continue
+                
+            if start == 0:
+                return None
+            
+            chunk *= 2
+            
+def get_appids_path(download_path, journal_filename):
+    return os.path.join(download_path, journal_filename + ".appids")
+
+def append_completed_appids(download_path, journal_filename, checkpoint, appids):
+    #completed appids are kept as raw int64 next to the journal, a checkpoint says how many of them are committed
+    rel_path = get_appids_path(download_path, journal_filename)
+    
+    #a journal from before the appids file has its appids carried over
+    if checkpoint and "completed" not in checkpoint:
+        appids = np.concatenate([read_completed_appids(download_path, journal_filename, checkpoint),
+                                 np.asarray(appids, dtype="<i8")])
+        checkpoint = None
+    
+    completed = checkpoint["completed"] if checkpoint else 0
+    
+    with open(rel_path, "r+b" if os.path.exists(rel_path) else "wb") as f:
+        #appids of a batch that never got its checkpoint are dropped first
+        f.truncate(completed * 8)
+        f.seek(0, os.SEEK_END)
+        f.write(np.asarray(appids, dtype="<i8").tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+        
+    return completed + len(appids)
+
+def read_completed_appids(download_path, journal_filename, checkpoint):
+    if checkpoint is None:
+        return np.empty(0, dtype="<i8")
+    
+    #journals written before the appids file list appids in every checkpoint
+    if "completed" not in checkpoint:
+        appids = []
+        with open(os.path.join(download_path, journal_filename), "rb") as f:
+            for line in f:
+                try:
+                    appids += json.loads(line).get("appids", [])
+                except ValueError:
+                    continue
+        return np.asarray(appids, dtype="<i8")
+    
+    return np.fromfile(get_appids_path(download_path, journal_filename), dtype="<i8", count=checkpoint["completed"])
+
+def recover_data_file(rel_path, checkpoint):
+    if checkpoint is None:
+        return 0
+    
+    #an upsert committed its checkpoint but died before swapping the rewritten file in
+    tmp_path = rel_path + ".tmp"
+    if os.path.exists(tmp_path):
+        if os.path.getsize(tmp_path) == checkpoint["size"]:
+            print("Finishing interrupted upsert of {}".format(rel_path))
+            os.replace(tmp_path, rel_path)
+        else:
+            os.remove(tmp_path)
+    
+    with open(rel_path, "r+b") as f:
+        if f.seek(0, os.SEEK_END) > checkpoint["size"]:
+            print("Dropping rows written after last checkpoint in {}".format(rel_path))
+            f.truncate(checkpoint["size"])
+            
+    return checkpoint["rows"]
+
 #%% functions definition
+@metrics.stage()
 def get_request(url_a, parameters=None):
-    try:
-        response = requests.get(url=url_a, params=parameters)
-    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as s:
-        print('Error:', s)
+    #fresh cached responses cost a disk read instead of a rate limited api call
+    json_data = read_cache(url_a, parameters)
+    if json_data is not None:
+        return json_data
+    
+    limiter = get_rate_limiter(url_a)
+    client = get_session()
+    status_429 = 0
+    
+    for attempt in range(max_attempts):
+        if limiter is not None:
+            take_token(limiter)
         
-        for i in range(5, 0, -1):
-            print('\rWaiting... ({})'.format(i), end=" ")
-            time.sleep(1)
-        print('\rRetrying.' + ' '*10)
+        start_time = time.perf_counter()
         
-        # recusively try again
-        return get_request(url_a,parameters)
+        try:
+            response = client.get(url=url_a, params=parameters, timeout=request_timeout)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as s:
+            print('Error:', s)
+            wait = get_backoff(attempt)
+        else:
+            latency = time.perf_counter() - start_time
+            
+            if response:
+                record_request(url_a, parameters, latency, attempt, status_429)
+                json_data = response.json()
+                write_cache(url_a, parameters, json_data)
+                return json_data
+            
+            # no response usually means too many requests, the server may tell us how long to wait
+            if response.status_code == 429:
+                status_429 += 1
+                
+            wait = get_retry_after(response)
+            if wait is None:
+                wait = get_backoff(attempt)
+                
+            print('\rNo response ({}), waiting {:.1f} sec...'.format(response.status_code, wait))
+        
+        if attempt < max_attempts - 1:
+            time.sleep(wait)
+            print("Retrying.")
     
-    if response:
-        return response.json()
-    else:
-        # response is none usually means too many requests. Wait and try again 
-        print('\rNo response, waiting 5 sec...')
-        time.sleep(5)
-        print("Retrying.")
-        return get_request(url_a, parameters)
+    record_request(url_a, parameters, None, max_attempts - 1, status_429, failed=True)
+    raise requests.exceptions.RetryError("No response from {} after {} attempts".format(url_a, max_attempts))
     
-def get_app_data(start, stop, parser, pause):
+def get_app_data(app_list, start, stop, parser, pause):
     app_data = []
     
     #iterate through each row of app_list, confined by start and stop
@@ -65,7 +504,51 @@ def get_app_data(start, stop, parser, pause):
         
     return app_data
 
-def process_batches(parser, app_list, download_path, data_filename, index_filename, columns, begin=0, end=-1, batchsize=100, pause=1):
+def get_app_data_concurrent(app_list, start, stop, parser, concurrency):
+    print("\nCurrent index: {}-{}".format(start, stop - 1), end='\r')
+    
+    batch = app_list[start:stop]
+    
+    # parsers block on requests, so run them in a pool sized to the number of requests in flight
+    # pacing is done by the per host token buckets in get_request instead of a fixed pause
+    # no event loop involved, so this also runs in spyder and ipython consoles that already have one
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # map keeps the order of app_list, so the csv looks the same as in serial mode
+        return list(executor.map(parser, batch["appid"], batch["name"]))
+
+def encode_nested(data):
+    #nested fields are written as json instead of python repr, so cleaning can parse them with json
+    return {key: json.dumps(value) if isinstance(value, (dict, list)) else value for key, value in data.items()}
+
+def write_app_data(app_data, download_path, data_filename, columns, batch_id, storage_format='csv'):
+    rel_path = os.path.join(download_path, data_filename)
+    
+    if storage_format == 'csv':
+        #writing app data to file, synced to disk before the checkpoint is committed
+        with open(rel_path, 'a', newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+            writer.writerows(encode_nested(data) for data in app_data)
+            f.flush()
+            os.fsync(f.fileno())
+            
+        return os.path.getsize(rel_path)
+    
+    #columnar batches are separate files named after the batch, so there is nothing to truncate on resume
+    name = os.path.splitext(data_filename)[0]
+    key = 'steam_appid' if 'steam_appid' in columns else 'appid'
+    storage.write_rows(app_data, download_path, name, columns, key, batch_id, fmt=storage_format)
+    
+    return 0
+
+def process_batches(parser, app_list, download_path, data_filename, journal_filename, columns, begin=0, end=-1, batchsize=100, pause=1, concurrency=None, storage_format='csv'):
+    checkpoint = read_checkpoint(download_path, journal_filename)
+    
+    #apps committed to the journal are skipped by appid, a rebuilt app list with shifted positions resumes correctly
+    completed = read_completed_appids(download_path, journal_filename, checkpoint)
+    if len(completed):
+        app_list = app_list[~app_list["appid"].isin(completed)].reset_index(drop=True)
+        print("Skipping {} apps already in the journal".format(len(completed)))
+    
     print("Starting at index {}:\n".format(begin))
     
     #by default, process all apps in app_list
@@ -76,6 +559,23 @@ def process_batches(parser, app_list, download_path, data_filename, index_filena
     batches = np.arange(begin, end, batchsize)
     batches = np.append(batches, end)
     
+    rel_path = os.path.join(download_path, data_filename)
+    
+    #drop rows written after the last checkpoint, they will be downloaded again
+    if storage_format == 'csv':
+        rows_count = recover_data_file(rel_path, checkpoint)
+    else:
+        rows_count = checkpoint["rows"] if checkpoint else 0
+    
+    #index counts apps committed so far, 0 means a fresh data file (see prepare_data_file)
+    apps_count = checkpoint["index"] if checkpoint else 0
+    
+    #columnar batch files are numbered on from the last committed batch, files of a batch that never got
+    #its checkpoint are removed, their apps are still pending and come back in a new batch
+    batch_id = checkpoint.get("batch", -1) + 1 if checkpoint else 0
+    if storage_format != 'csv':
+        storage.remove_batches(download_path, os.path.splitext(data_filename)[0], batch_id, fmt=storage_format)
+    
     apps_written = 0
     batch_times = []
     
@@ -85,29 +585,32 @@ def process_batches(parser, app_list, download_path, data_filename, index_filena
         start = batches[i]
         stop = batches [i + 1]
         
-        app_data = get_app_data(start, stop, parser, pause)
+        with metrics.timer("download_batch", rows_in=len(app_list[start:stop])) as record:
+            if concurrency:
+                app_data = get_app_data_concurrent(app_list, start, stop, parser, concurrency)
+            else:
+                app_data = get_app_data(app_list, start, stop, parser, pause)
+            record["rows_out"] = len(app_data)
         
-        rel_path = os.path.join(download_path, data_filename)
-        
-        #writing app data to file
-        with open(rel_path, 'a', newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
-            
-            for j in range(3,0,-1):
-                print("\rAbout to write data, don't stop script! ({})".format(j), end="")
-                time.sleep(0.5)
-                
-            writer.writerows(app_data)
-            print("\rExported lines {}-{} to {}.".format(start, stop-1, data_filename), end=" ")
+        with metrics.timer("write_batch", rows_in=len(app_data)) as record:
+            size = write_app_data(app_data, download_path, data_filename, columns, batch_id, storage_format)
+            record["rows_out"] = len(app_data)
+        print("\rExported lines {}-{} to {}.".format(start, stop-1, data_filename), end=" ")
             
         apps_written += len(app_data)
+        rows_count += len(app_data)
+        apps_count += len(app_data)
         
-        idx_path = os.path.join(download_path, index_filename)
-        
-        #writing last index to file
-        with open(idx_path, "w") as f:
-            index = stop
-            print(index, file=f)
+        #committing the batch, a crash before the checkpoint only repeats the batch on restart
+        checkpoint = {
+            "index": apps_count,
+            "rows": rows_count,
+            "size": size,
+            "completed": append_completed_appids(download_path, journal_filename, checkpoint, app_list["appid"][start:stop]),
+            "batch": batch_id,
+            }
+        append_checkpoint(download_path, journal_filename, checkpoint)
+        batch_id += 1
             
         #logging time taken
         end_time = time.time()
@@ -125,28 +628,30 @@ def process_batches(parser, app_list, download_path, data_filename, index_filena
         print("Batch {} time: {} (avg: {}, reamining: {})".format(i, time_td, mean_td, reamining_td))
         
     print("\nProcessing batches complete. {} apps written".format(apps_written))
-        
-def reset_index(download_path, index_filename):
-    rel_path = os.path.join(download_path, index_filename)
+    print_request_stats()
+
+def reset_index(download_path, journal_filename):
+    rel_path = os.path.join(download_path, journal_filename)
     
-    with open(rel_path, "w") as f:
-        print(0, file=f)
+    with open(rel_path, "w"):
+        pass
         
-def get_index(download_path, index_filename):
-    try:
-        rel_path = os.path.join(download_path, index_filename)
-        
-        with open(rel_path, "r") as f:
-            index = int(f.readline())
-            
-    except FileNotFoundError:
+def get_index(download_path, journal_filename):
+    checkpoint = read_checkpoint(download_path, journal_filename)
+    
+    if checkpoint is None:
         index = 0
-        print("File Not Found Error, index = {}".format(index))
+        print("No checkpoint found, index = {}".format(index))
+    else:
+        index = checkpoint["index"]
     
     return index
     
-def prepare_data_file(download_path, filename, index, columns, page_number):
-    if index == 0 and page_number == 0:
+def prepare_data_file(download_path, filename, index, columns, storage_format='csv'):
+    if index == 0 and storage_format != 'csv':
+        storage.remove_table(download_path, os.path.splitext(filename)[0], fmt=storage_format)
+        
+    elif index == 0:
         rel_path = os.path.join(download_path, filename)
         
         with open(rel_path, "w", newline="") as f:
@@ -154,7 +659,7 @@ def prepare_data_file(download_path, filename, index, columns, page_number):
             writer.writeheader()
             
 def parse_steam_request(appid, name):
-    url = "http://store.steampowered.com/api/appdetails/"
+    url = STEAM_URL
     parameters = {"appids": appid}
     
     json_data = get_request(url, parameters=parameters)
@@ -168,25 +673,275 @@ def parse_steam_request(appid, name):
     return data
 
 def parse_steamspy_request(appid, name):
-    url = "https://steamspy.com/api.php"
+    url = STEAMSPY_URL
     parameters = {"request": "appdetails", "appid": appid}
     
     json_data = get_request(url, parameters=parameters)
 
     return json_data
 
-def get_page_number(download_path, data_filename):
-    try:
-        rel_path = os.path.join(download_path, data_filename)
+#%% app list
+# columns kept from steamspy 'all' pages, appid and name for downloading, the rest for incremental refresh
+app_list_columns = ['appid', 'name', 'owners', 'ccu', 'price', 'positive', 'negative']
+
+def get_all_page(page):
+    parameters = {"request": "all", "page": page}
+    
+    #pages come from the response cache when it is configured, no need to wait for those
+    json_data = read_cache(STEAMSPY_URL, parameters)
+    if json_data is not None:
+        return json_data, True
     
-        rows_count = pd.read_csv(rel_path).shape[0]
-        page_number = rows_count//1000
+    return get_request(STEAMSPY_URL, parameters=parameters), False
+
+def iter_app_list(pause=60, max_pages=1000):
+    #steamspy serves 'all' in pages of 1000 apps and allows one such request per minute
+    for page in range(max_pages):
+        json_data, cached = get_all_page(page)
         
-    except FileNotFoundError:
-        page_number = 0
-        print("File Not Found Error, page = {}".format(page_number))
+        #page past the end of the catalogue comes back empty
+        if not json_data:
+            return
+        
+        print("\rApp list page {}: {} apps{}".format(page, len(json_data), " (cached)" if cached else ""), end=" ")
+        
+        for data in json_data.values():
+            yield {column: data.get(column) for column in app_list_columns}
+            
+        if not cached:
+            time.sleep(pause)
+            
+def build_app_list(download_path, app_list_filename, pause=60, max_pages=1000):
+    rel_path = os.path.join(download_path, app_list_filename)
+    tmp_path = rel_path + ".tmp"
+    
+    #stream records straight to disk, only one page and the appids seen so far are held in memory
+    seen = set()
+    last_appid = -1
+    in_order = True
+    
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=app_list_columns)
+        writer.writeheader()
+        
+        for record in iter_app_list(pause, max_pages):
+            appid = int(record["appid"])
+            
+            #apps can move between pages while downloading, the first row of an appid is kept
+            if appid in seen:
+                continue
+            
+            seen.add(appid)
+            in_order = in_order and appid > last_appid
+            last_appid = appid
+            writer.writerow(record)
+            
+    #pages come in appid order, the list is only loaded to sort it when the api mixed them up
+    if not in_order:
+        print("\nApp list pages out of appid order, sorting")
+        app_list = pd.read_csv(tmp_path).sort_values('appid').reset_index(drop=True)
+        app_list.to_csv(tmp_path, index=False)
+    
+    os.replace(tmp_path, rel_path)
+    
+    print("\nApp list with {} apps written to {}".format(len(seen), app_list_filename))
+    
+    return rel_path
+
+#%% sharded download
+def get_shard_filename(filename, shard):
+    base, ext = os.path.splitext(filename)
+    
+    return "{}.part{}{}".format(base, shard, ext)
+
+def run_shard(shard, parser, app_list, download_path, data_filename, journal_filename, columns, batchsize, pause, concurrency, proxy, shard_rate_limits):
+    global proxies, rate_limits
+    
+    #runs in a worker process, so session and token buckets here are this shard's own rate budget
+    proxies = proxy
+    rate_limits = shard_rate_limits
+    with rate_limiters_lock:
+        rate_limiters.clear()
+    
+    part_data = get_shard_filename(data_filename, shard)
+    part_journal = get_shard_filename(journal_filename, shard)
+    
+    index = get_index(download_path, part_journal)
+    prepare_data_file(download_path, part_data, index, columns)
     
-    return str(page_number)
+    process_batches(parser=parser, app_list=app_list, download_path=download_path, data_filename=part_data,
+                    journal_filename=part_journal, columns=columns, batchsize=batchsize,
+                    pause=pause, concurrency=concurrency)
+    
+    return part_data
+
+def merge_shards(download_path, part_files, data_filename):
+    rel_path = os.path.join(download_path, data_filename)
+    tmp_path = rel_path + ".tmp"
+    
+    #parts hold consecutive appid ranges, so concatenating them in order keeps the ranges in appid order
+    #(apps added to a range by a rebuilt app list come at the end of its part)
+    with open(tmp_path, "wb") as out:
+        for shard, part_file in enumerate(part_files):
+            with open(os.path.join(download_path, part_file), "rb") as f:
+                header = f.readline()
+                
+                if shard == 0:
+                    out.write(header)
+                    
+                shutil.copyfileobj(f, out)
+                
+        out.flush()
+        os.fsync(out.fileno())
+        
+    os.replace(tmp_path, rel_path)
+    print("Merged {} parts into {}".format(len(part_files), data_filename))
+
+def get_shard_bounds(download_path, journal_filename, app_list, workers):
+    #appids splitting the shards, fixed at the first run, so a rebuilt app list keeps every app in the shard
+    #whose journal already has it
+    rel_path = os.path.join(download_path, journal_filename + ".shards.json")
+    
+    if os.path.exists(rel_path):
+        with open(rel_path, encoding="utf-8") as f:
+            return json.load(f)
+        
+    positions = np.linspace(0, len(app_list), workers + 1).astype(int)[1:-1]
+    bounds = [int(appid) for appid in app_list["appid"].iloc[positions]]
+    
+    with open(rel_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(bounds, f)
+    os.replace(rel_path + ".tmp", rel_path)
+    
+    return bounds
+
+def process_shards(parser, app_list, download_path, data_filename, journal_filename, columns, workers=4, batchsize=100, pause=1, concurrency=None, shard_proxies=None):
+    bounds = get_shard_bounds(download_path, journal_filename, app_list, workers)
+    
+    #journals and part files belong to the shards of the first run, so their number can't change
+    if len(bounds) + 1 != workers:
+        print("Keeping {} workers of the first run".format(len(bounds) + 1))
+        workers = len(bounds) + 1
+        
+    shards = np.searchsorted(bounds, app_list["appid"].to_numpy(), side="right")
+    
+    if shard_proxies is None:
+        shard_proxies = [None] * workers
+    
+    #apis limit requests per ip, shards without their own proxy share one budget instead of multiplying it
+    egress = [json.dumps(proxy, sort_keys=True) for proxy in shard_proxies]
+    ip_shares = [egress.count(proxy) for proxy in egress]
+    shard_rate_limits = [{host: rate / share for host, rate in rate_limits.items()} for share in ip_shares]
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        
+        for shard in range(workers):
+            shard_list = app_list[shards == shard].reset_index(drop=True)
+            futures.append(executor.submit(run_shard, shard, parser, shard_list, download_path, data_filename,
+                                           journal_filename, columns, batchsize, pause, concurrency,
+                                           shard_proxies[shard], shard_rate_limits[shard]))
+            
+        part_files = [future.result() for future in futures]
+        
+    merge_shards(download_path, part_files, data_filename)
+    
+#%% incremental refresh
+# steamspy 'all' fields that tell us an app changed since the last download
+change_columns = ['owners', 'ccu', 'price', 'positive', 'negative']
+
+def get_updates_filename(filename):
+    base, ext = os.path.splitext(filename)
+    
+    return "{}.updates{}".format(base, ext)
+
+def normalize_column(series):
+    #compare numbers as numbers, so 999 from the api equals '999' or 999.0 read back from csv
+    numeric = pd.to_numeric(series, errors='coerce')
+    
+    return numeric.astype(object).where(numeric.notnull(), series.astype(str))
+
+def get_changed_apps(all_data, stored_data, compare_columns=change_columns):
+    fresh = all_data[['appid', 'name'] + compare_columns].copy()
+    stored = stored_data[['appid'] + compare_columns].drop_duplicates('appid', keep='last')
+    
+    fresh['appid'] = pd.to_numeric(fresh['appid'])
+    stored['appid'] = pd.to_numeric(stored['appid'])
+    
+    merged = fresh.merge(stored, on='appid', how='left', suffixes=('', '_stored'), indicator=True)
+    changed = merged['_merge'] == 'left_only'
+    
+    for column in compare_columns:
+        changed |= normalize_column(merged[column]) != normalize_column(merged[column + '_stored'])
+        
+    changed_apps = merged.loc[changed, ['appid', 'name']].sort_values('appid').reset_index(drop=True)
+    print("{} of {} apps are new or changed".format(len(changed_apps), len(fresh)))
+    
+    return changed_apps
+
+def upsert_data(download_path, data_filename, updates_filename, journal_filename, key):
+    rel_path = os.path.join(download_path, data_filename)
+    upd_path = os.path.join(download_path, updates_filename)
+    tmp_path = rel_path + ".tmp"
+    
+    #read everything as text, so rows that are not updated are written back unchanged
+    data = pd.read_csv(rel_path, dtype=str, keep_default_na=False)
+    updates = pd.read_csv(upd_path, dtype=str, keep_default_na=False)
+    
+    data = pd.concat([data, updates], ignore_index=True)
+    data = data.drop_duplicates(subset=key, keep='last')
+    data = data.sort_values(key, key=lambda s: pd.to_numeric(s, errors='coerce'))
+    
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        data.to_csv(f, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+    
+    #the rewritten file gets its own checkpoint before it is swapped in, a resume would otherwise truncate
+    #it to the old size, a crash between the two is finished by recover_data_file
+    checkpoint = read_checkpoint(download_path, journal_filename)
+    appids = pd.to_numeric(updates[key], errors='coerce').dropna()
+    append_checkpoint(download_path, journal_filename, {
+        "index": checkpoint["index"] if checkpoint else len(data),
+        "rows": len(data),
+        "size": os.path.getsize(tmp_path),
+        "completed": append_completed_appids(download_path, journal_filename, checkpoint, appids),
+        })
+    os.replace(tmp_path, rel_path)
+    
+    print("Upserted {} rows into {}".format(len(updates), data_filename))
+
+def refresh_apps(parser, changed_apps, download_path, data_filename, journal_filename, columns, key, batchsize=100, pause=1, concurrency=None):
+    updates_filename = get_updates_filename(data_filename)
+    updates_journal = get_updates_filename(journal_filename)
+    
+    #updates go through their own file and journal, so an interrupted refresh resumes like a normal download
+    index = get_index(download_path, updates_journal)
+    prepare_data_file(download_path, updates_filename, index, columns)
+    
+    process_batches(parser=parser, app_list=changed_apps, download_path=download_path, data_filename=updates_filename,
+                    journal_filename=updates_journal, columns=columns, batchsize=batchsize,
+                    pause=pause, concurrency=concurrency)
+    
+    upsert_data(download_path, data_filename, updates_filename, journal_filename, key)
+    
+    #journal goes first, a refresh finding the journal without its data file could not resume
+    os.remove(os.path.join(download_path, updates_journal))
+    os.remove(get_appids_path(download_path, updates_journal))
+    os.remove(os.path.join(download_path, updates_filename))
+    
+def get_changed_app_list(download_path, changed_filename, all_data, data_filename):
+    rel_path = os.path.join(download_path, changed_filename)
+    
+    #the list is stored until refresh is finished, stored data changes while the refresh runs
+    if os.path.exists(rel_path):
+        return pd.read_csv(rel_path)
+    
+    stored_data = pd.read_csv(os.path.join(download_path, data_filename), usecols=['appid'] + change_columns)
+    changed_apps = get_changed_apps(all_data, stored_data)
+    changed_apps.to_csv(rel_path, index=False)
+    
+    return changed_apps
     
 #%% data downloading
 if __name__ == '__main__':
@@ -194,66 +949,57 @@ if __name__ == '__main__':
     # set file parameters
     download_path = "/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/1_files"
     steam_app_data = "steam_app_data.csv"
-    steam_index = "steam_index.txt"
+    steam_journal = "steam_journal.jsonl"
     steamspy_data = "steamspy_data.csv"
-    steamspy_index = "steamspy_index.txt"
+    steamspy_journal = "steamspy_journal.jsonl"
     
-    # gathering page number so we can continue file writing
-    page_number = get_page_number(download_path=download_path, data_filename=steamspy_data)
-    
-    url = 'https://steamspy.com/api.php?request=all&page='+page_number
-    parameters = {"request": "all"}
-    
-    # request 'all' from steam spy and parse into dataframe
-    json_data = get_request(url, parameters=parameters)
-    steam_spy_all = pd.DataFrame.from_dict(json_data, orient='index') 
+    app_list_filename = "app_list.csv"
     
-    # generate sorted app_list from steamspy data
-    app_list = steam_spy_all[['appid', 'name']].sort_values('appid').reset_index(drop=True)
+    # raw api responses are kept on disk, re-runs and new columns are served from there while fresh (see cache_ttls)
+    configure_cache(os.path.join(download_path, "response_cache"), max_bytes=20 * 1024**3)
     
-    # export disabled to keep consistency across download sessions
-    app_list.to_csv('/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/1_files/app_list.csv', index=False)
+    # stream every steamspy 'all' page into a sorted app list once, later sessions read it from disk
+    # delete the app list to pick up new apps (needed before an incremental refresh)
+    if not os.path.exists(os.path.join(download_path, app_list_filename)):
+        build_app_list(download_path, app_list_filename)
     
-    # instead read from stored csv
-    app_list = pd.read_csv('/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/1_files/app_list.csv')
-    
-    steam_columns = [
-    'type', 'name', 'steam_appid', 'required_age', 'is_free', 'controller_support',
-    'dlc', 'detailed_description', 'about_the_game', 'short_description', 'fullgame',
-    'supported_languages', 'header_image', 'website', 'pc_requirements', 'mac_requirements',
-    'linux_requirements', 'legal_notice', 'drm_notice', 'ext_user_account_notice',
-    'developers', 'publishers', 'demos', 'price_overview', 'packages', 'package_groups',
-    'platforms', 'metacritic', 'reviews', 'categories', 'genres', 'screenshots',
-    'movies', 'recommendations', 'achievements', 'release_date', 'support_info',
-    'background', 'content_descriptors']
-
-    steamspy_columns = [
-    'appid', 'name', 'developer', 'publisher', 'score_rank', 'positive',
-    'negative', 'userscore', 'owners', 'average_forever', 'average_2weeks',
-    'median_forever', 'median_2weeks', 'price', 'initialprice', 'discount',
-    'languages', 'genre', 'ccu', 'tags']
+    app_list = pd.read_csv(os.path.join(download_path, app_list_filename))
     
     # overwrites last index for demonstration (would usually store highest index so can continue across sessions)
-    # reset_index(download_path, steam_index)
-    # reset_index(download_path, steamspy_index)
+    # reset_index(download_path, steam_journal)
+    # reset_index(download_path, steamspy_journal)
     
-    # retrieve last index downloaded from file
-    #index = get_index(download_path, steam_index)
-    index = get_index(download_path, steamspy_index)
-    if index%1000 == 1:
-        index = 0
+    # retrieve number of apps committed to the checkpoint journal, 0 starts a fresh data file
+    # process_batches itself skips the appids in the journal, so begin stays 0 across sessions
+    #index = get_index(download_path, steam_journal)
+    index = get_index(download_path, steamspy_journal)
 
-    # wipe or create data file and write headers if index is 0 and page_number is 0
-    #prepare_data_file(download_path, steam_app_data, index, steam_columns, page_number)
-    prepare_data_file(download_path, steamspy_data, index, steamspy_columns, page_number)
+    # wipe or create data file and write headers if index is 0
+    #prepare_data_file(download_path, steam_app_data, index, steam_columns)
+    prepare_data_file(download_path, steamspy_data, index, steamspy_columns)
 
     # set end and chunksize for demonstration - remove to run through entire app list
-    #process_batches(parser=parse_steam_request, app_list=app_list, download_path=download_path, data_filename=steam_app_data, index_filename=steam_index, columns=steam_columns, begin=index, batchsize=20)
-    process_batches(parser=parse_steamspy_request, app_list=app_list, download_path=download_path,  data_filename=steamspy_data, index_filename=steamspy_index, columns=steamspy_columns, begin=index, batchsize=20)
+    # concurrency sets number of requests in flight, None falls back to serial download with pause
+    # storage_format='parquet' (same for prepare_data_file) writes partitioned parquet batches instead of csv rows
+    #process_batches(parser=parse_steam_request, app_list=app_list, download_path=download_path, data_filename=steam_app_data, journal_filename=steam_journal, columns=steam_columns, batchsize=20, concurrency=4)
+    process_batches(parser=parse_steamspy_request, app_list=app_list, download_path=download_path,  data_filename=steamspy_data, journal_filename=steamspy_journal, columns=steamspy_columns, batchsize=20, concurrency=4)
+    
+    # sharded mode splits app_list over worker processes, each with its own journal and part file
+    # workers share the per host rate limits unless shard_proxies gives them separate egress ips
+    #process_shards(parser=parse_steam_request, app_list=app_list, download_path=download_path, data_filename=steam_app_data, journal_filename=steam_journal, columns=steam_columns, workers=4, batchsize=20, concurrency=4)
+    
+    # incremental refresh: download details only for apps whose steamspy 'all' data changed, then upsert them
+    #changed_apps = get_changed_app_list(download_path, "changed_apps.csv", app_list, steamspy_data)
+    #refresh_apps(parser=parse_steam_request, changed_apps=changed_apps, download_path=download_path, data_filename=steam_app_data, journal_filename=steam_journal, columns=steam_columns, key='steam_appid', batchsize=20, concurrency=4)
+    #refresh_apps(parser=parse_steamspy_request, changed_apps=changed_apps, download_path=download_path, data_filename=steamspy_data, journal_filename=steamspy_journal, columns=steamspy_columns, key='appid', batchsize=20, concurrency=4)
+    #os.remove(os.path.join(download_path, "changed_apps.csv"))
 
     #Data_downloaded = pd.read_csv('/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/1_files/steam_app_data.csv').head(15)
     Data_downloaded = pd.read_csv('/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/1_files/steamspy_data.csv').head(15)
 
     time.sleep(2)
+    
+    # time per batch and per request, collected only when STEAM_METRICS names a file (see metrics.py)
+    metrics.print_stages()
 
 #%% end?
\ No newline at end of file
@@ -8,8 +8,13 @@ This file is about to celaning data
 """
 
 #%% standard library imports
-from ast import literal_eval
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
 import itertools
+import json
+import os
+import shutil
+import tempfile
 import time
 import re
 
@@ -17,16 +22,73 @@ import re
 import numpy as np
 import pandas as pd
 
+#%% local imports
+import analytics
+import metrics
+import pipeline
+import storage
+from storage import parse_nested, parse_value
+
 #%% customisations
 pd.options.display.max_columns = 100
 pd.set_option('display.max_colwidth', None)
 
+# where and how cleaned tables are written, 'parquet' keeps typed columns and lets us read only selected ones
+export_path = '/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/2_files/'
+export_format = 'csv'
+# column used to partition parquet exports by appid range, None writes a single file in row order
+export_key = 'steam_appid'
+
+# local table of PLN per unit of currency by date, exchange_rates_date picks the rates in force that day (None = latest)
+exchange_rates_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exchange_rates.csv')
+exchange_rates_date = None
+
+# rates loaded so far by path, date and file modification time, changing any of them loads the table again
+exchange_rates = {}
+
+# side tables written by the exporting steps of process
+side_tables = ['description_data', 'media_data', 'support_data', 'requirements_data']
+
+# when set (see start_side_table_writer) export_data hands tables to background threads instead of writing them itself
+side_table_writer = None
+
 #%% functions definition
+def load_exchange_rates(path, as_of=None):
+    rates = pd.read_csv(path, parse_dates=['date'])
+    
+    if as_of is not None:
+        rates = rates[rates['date'] <= pd.Timestamp(as_of)]
+        
+    rates = rates.sort_values('date').drop_duplicates('currency', keep='last')
+    
+    return rates.set_index('currency')['rate']
+
+def get_exchange_rates():
+    key = (exchange_rates_path, exchange_rates_date, os.path.getmtime(exchange_rates_path))
+    
+    if key not in exchange_rates:
+        exchange_rates[key] = load_exchange_rates(exchange_rates_path, exchange_rates_date)
+        
+    return exchange_rates[key]
+
+def convert_prices(df):
+    # prices come in hundredths of the store currency, rows in currencies missing from the table keep a NaN price
+    df['price_original'] = df['price'] / 100
+    df['price'] = df['price_original'] * df['currency'].map(get_exchange_rates())
+    
+    missing = df.loc[df['price'].isnull(), 'currency'].unique()
+    if len(missing):
+        print("No exchange rate for: {}".format(', '.join(missing)))
+    
+    return df
+
+@metrics.stage()
 def drop_null_cols(df, thresh=0.5):
     cutoff_count = len(df) * thresh
     
     return df.dropna(thresh=cutoff_count, axis=1)
 
+@metrics.stage()
 def process_name_type(df):
     df = df[df['type'].notnull()]
     df = df[df['name'].notnull()]
@@ -35,6 +97,7 @@ def process_name_type(df):
     
     return df
 
+@metrics.stage()
 def process_age(df):
     cut_points = [-1, 0, 3, 7, 12, 16, 2000]
     label_values = [0, 3, 7, 12, 16, 18]
@@ -44,27 +107,26 @@ def process_age(df):
     
     return df
 
+@metrics.stage()
 def process_platforms(df):
-    df['platforms'] = df['platforms'].apply(literal_eval)
+    df['platforms'] = parse_nested(df['platforms'])
     df['platforms'] = df['platforms'].apply(lambda i: ';'.join(x for x in i.keys() if i[x]))
     
     return df
 
+@metrics.stage()
 def process_price(df):
-    df['price_overview'] = df['price_overview'].apply(lambda i: {'currency': 'PLN', 'initial': -1} if i is np.nan else literal_eval(i))
+    df['price_overview'] = parse_nested(df['price_overview']).apply(lambda i: i if isinstance(i, dict) else {'currency': 'PLN', 'initial': -1})
     df['currency'] = df['price_overview'].apply(lambda i: i['currency'])
     df['price'] = df['price_overview'].apply(lambda i: i['initial'])
     df.loc[df['is_free'], 'price'] = 0
-    df.loc[df['currency']=='EUR', 'price'] *= 4.5
-    df.loc[df['currency']=='USD', 'price'] *= 4.3
-    df['currency'] = df['currency'].apply(lambda i: 'PLN' if i in ['EUR', 'USD'] else i)
-    df.drop(df[df['currency']!='PLN'].index, inplace=True)
-    df=df[df['price']!=-1]
-    df.drop(['is_free', 'currency', 'price_overview', 'packages', 'package_groups'], axis=1, inplace=True)
-    df['price'] /= 100
+    df=df[df['price']!=-1].copy()
+    df = convert_prices(df)
+    df.drop(['is_free', 'price_overview', 'packages', 'package_groups'], axis=1, inplace=True)
 
     return df
 
+@metrics.stage()
 def process_language(df):
     df.dropna(subset=['supported_languages'], inplace=True)
     df['english'] = df['supported_languages'].apply(lambda x: 1 if 'english' in x.lower() else 0)
@@ -72,58 +134,124 @@ def process_language(df):
 
     return df
 
+@metrics.stage()
 def process_dev_and_pub(df):
-    df = df[(df['developers'].notnull()) & (df['publishers'] != "['']")].copy()
+    df = df[(df['developers'].notnull()) & ~(df['publishers'].isin(["['']", '[""]']))].copy()
     df = df[~(df['developers'].str.contains(';')) & ~(df['publishers'].str.contains(';'))]
-    df = df[(df['publishers'] != "['NA']") & (df['publishers'] != "['N/A']")]
+    df = df[~(df['publishers'].isin(["['NA']", "['N/A']", '["NA"]', '["N/A"]']))]
 
-    df['developer'] = df['developers'].apply(lambda x: ';'.join(literal_eval(x)))
-    df['publisher'] = df['publishers'].apply(lambda x: ';'.join(literal_eval(x)))
+    df['developer'] = parse_nested(df['developers']).str.join(';')
+    df['publisher'] = parse_nested(df['publishers']).str.join(';')
 
     df.drop(['developers', 'publishers'], axis=1, inplace=True)
 
     return df
 
+@metrics.stage()
 def process_cat_and_gen(df):
     df = df[(df['categories'].notnull()) & (df['genres'].notnull())]
     for i in ['categories', 'genres']:
-        df[i] = df[i].apply(lambda x: ';'.join(y['description'] for y in literal_eval(x)))
+        df[i] = parse_nested(df[i]).apply(lambda x: ';'.join(y['description'] for y in x))
 
     return df
 
+@metrics.stage()
 def process_achiev_recom_and_desc(df):
     df.drop(['content_descriptors'], axis=1, inplace=True)
-    df['achievements'] = df['achievements'].apply(lambda x: 0 if x is np.nan else literal_eval(x)['total'])
-    df['recommendations'] = df['recommendations'].apply(lambda x: 0 if x is np.nan else literal_eval(x)['total'])
+    df['achievements'] = parse_nested(df['achievements']).apply(lambda x: x['total'] if isinstance(x, dict) else 0)
+    df['recommendations'] = parse_nested(df['recommendations']).apply(lambda x: x['total'] if isinstance(x, dict) else 0)
 
     return df
 
-def export_data(df, filename):
-    filepath = '/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/2_files/' + filename + '.csv'
-    df.to_csv(filepath, index=False)
+@metrics.stage()
+def export_data(df, filename, append=False):
+    # only side tables go through the writer, the main table is written in export_format for the next scripts
+    if side_table_writer is not None and filename in side_tables:
+        write_side_table(side_table_writer, filename, df, append=append)
+        return
+    
+    filepath = storage.write_table(df, export_path, filename, fmt=export_format, key=export_key, append=append)
+    
+    print("Exported {} to '{}'".format(filename, filepath))
+
+#%% side table writer
+def start_side_table_writer(fmt='parquet', max_workers=4, keep_frames=True):
+    # keep_frames=False for streaming cleaning, handles then read the written table back when asked
+    return {'executor': ThreadPoolExecutor(max_workers=max_workers), 'fmt': fmt, 'keep_frames': keep_frames, 'tables': {}}
+
+def write_table_after(previous, df, filename, fmt, append):
+    # appends to one table must land in order, so each write waits for the one before it
+    if previous is not None:
+        previous.result()
     
+    filepath = storage.write_table(df, export_path, filename, fmt=fmt, key=export_key, append=append)
     print("Exported {} to '{}'".format(filename, filepath))
+    
+    return filepath
+
+def write_side_table(writer, filename, df, append=False):
+    table = writer['tables'].get(filename)
+    previous = table['future'] if table else None
+    
+    future = writer['executor'].submit(write_table_after, previous, df, filename, writer['fmt'], append)
+    
+    # the frame handed in is the only copy of these columns, it is kept as the handle instead of re-reading the file
+    if not writer['keep_frames']:
+        frames = []
+    elif table and append:
+        frames = table['frames'] + [df]
+    else:
+        frames = [df]
+    writer['tables'][filename] = {'future': future, 'frames': frames}
+    
+    return writer['tables'][filename]
+
+def get_side_table(writer, filename, columns=None):
+    table = writer['tables'][filename]
+    frames = table['frames']
+    
+    if not frames:
+        table['future'].result()
+        return storage.read_table(export_path, filename, fmt=writer['fmt'], columns=columns)
+    
+    df = frames[0] if len(frames) == 1 else pd.concat(frames)
+    
+    return df if columns is None else df[columns]
+
+def close_side_table_writer(writer):
+    # waits for every write and raises the first error a background write hit
+    for table in writer['tables'].values():
+        table['future'].result()
+        
+    writer['executor'].shutdown()
+
+def get_description_data(df):
+    return df[['steam_appid', 'detailed_description', 'about_the_game', 'short_description']]
+
+def get_media_data(df):
+    return df[['steam_appid', 'header_image', 'screenshots', 'background', 'movies']]
 
-def process_descriptions(df, export=False):
+@metrics.stage()
+def process_descriptions(df, export=False, append=False):
     if export:
-        description_data = df[['steam_appid', 'detailed_description', 'about_the_game', 'short_description']]
-        export_data(description_data, filename='description_data')
+        export_data(get_description_data(df), filename='description_data', append=append)
     df.drop(['detailed_description', 'about_the_game', 'short_description'], axis=1, inplace=True)
 
     return df
 
-def process_media(df, export=False):
+@metrics.stage()
+def process_media(df, export=False, append=False):
     if export:
-        media_data = df[['steam_appid', 'header_image', 'screenshots', 'background', 'movies']]
-        export_data(media_data, filename='media_data')
+        export_data(get_media_data(df), filename='media_data', append=append)
     df.drop(['header_image', 'screenshots', 'background', 'movies'], axis=1, inplace=True)
 
     return df
 
+@metrics.stage()
 def process_info(df, export=False):
     if export:
         support_info_data = df[['steam_appid', 'website', 'support_info']].copy()
-        support_info_data['support_info'] = support_info_data['support_info'].apply(lambda x: literal_eval(x))
+        support_info_data['support_info'] = parse_nested(support_info_data['support_info'])
         support_info_data['support_url'] = support_info_data['support_info'].apply(lambda x: x['url'])
         support_info_data['support_email'] = support_info_data['support_info'].apply(lambda x: x['email'])
         support_info_data.drop(['support_info'], axis=1, inplace=True)
@@ -132,6 +260,7 @@ def process_info(df, export=False):
 
     return df
 
+@metrics.stage()
 def process_requirements(df, export=False):
     if export:
         requirements_data = df[['steam_appid', 'pc_requirements', 'mac_requirements', 'linux_requirements']].copy()
@@ -140,22 +269,25 @@ def process_requirements(df, export=False):
                                                         .str.replace(r'<[pbr]{1,2}>', ' ', regex=True)
                                                         .str.replace(r'<[\/"=\w\s]+>', '', regex=True)
                                                       )
-        requirements_data['pc_requirements_clean'] = requirements_data['pc_requirements_clean'].apply(lambda x: literal_eval(x))
+        requirements_data['pc_requirements_clean'] = parse_nested(requirements_data['pc_requirements_clean'])
         requirements_data.drop(['pc_requirements_clean'], axis=1, inplace=True)
         export_data(requirements_data, filename='requirements_data')
     df.drop(['pc_requirements', 'mac_requirements', 'linux_requirements'], axis=1, inplace=True)
 
     return df
 
+@metrics.stage()
 def process_data_release(df):
-    df['release_date'] = df['release_date'].apply(lambda x: 0 if x is np.nan else literal_eval(x)['date'])
-    df['release_date'] = df['release_date'].apply(lambda x: x.replace(',', ''))
-    df['release_date'] = pd.to_datetime(df['release_date'], format='%d %b %Y', errors='coerce')
-    df = df[df['release_date'].notnull()]
+    release_date = parse_nested(df['release_date'])
+    df['coming_soon'] = release_date.apply(lambda x: bool(x.get('coming_soon')) if isinstance(x, dict) else False)
+    df['release_date'] = release_date.apply(lambda x: x['date'] if isinstance(x, dict) else '')
+    df['release_date'] = normalize_release_dates(df['release_date'])
+    df = df[df['release_date'].notnull() | df['coming_soon']]
 
     return df
 
-def process(df):
+@metrics.stage()
+def process(df, export=True):
     df = df.copy()
     df = df.drop_duplicates()
     df = drop_null_cols(df)
@@ -167,14 +299,711 @@ def process(df):
     df = process_dev_and_pub(df)
     df = process_cat_and_gen(df)
     df = process_achiev_recom_and_desc(df)
-    df = process_descriptions(df, export=True)
-    df = process_media(df, export=True)
-    df = process_info(df, export=True)
-    df = process_requirements(df, export=True)
+    df = process_descriptions(df, export=export)
+    df = process_media(df, export=export)
+    df = process_info(df, export=export)
+    df = process_requirements(df, export=export)
     df = process_data_release(df)
 
     return df
 
+#%% vectorized cleaning
+# same steps as process, but on whole columns: regex extraction instead of parsing each nested value where possible
+# patterns accept both json ("key": true) and python repr ('key': True) encodings of nested fields
+platform_names = ['windows', 'mac', 'linux']
+platform_pattern = r"""['"]{}['"]:\s*(?:true|True)"""
+currency_pattern = r"""['"]currency['"]:\s*['"](\w+)['"]"""
+initial_pattern = r"""['"]initial['"]:\s*(-?\d+)"""
+total_pattern = r"""['"]total['"]:\s*(\d+)"""
+date_pattern = r"""['"]date['"]:\s*(?:'([^']*)'|"([^"]*)")"""
+coming_soon_pattern = r"""['"]coming_soon['"]:\s*(?:true|True)"""
+
+
+@metrics.stage()
+def process_platforms_vectorized(df):
+    platforms = pd.Series('', index=df.index)
+    
+    for name in platform_names:
+        supported = df['platforms'].str.contains(platform_pattern.format(name), regex=True, na=False)
+        platforms = platforms + np.where(supported, name + ';', '')
+        
+    df['platforms'] = platforms.str.rstrip(';')
+    
+    return df
+
+@metrics.stage()
+def process_price_vectorized(df):
+    currency = df['price_overview'].str.extract(currency_pattern, expand=False).fillna('PLN')
+    price = pd.to_numeric(df['price_overview'].str.extract(initial_pattern, expand=False)).fillna(-1).astype('int64')
+    
+    df['currency'] = currency
+    df['price'] = price.where(df['is_free'] != True, 0)
+    
+    df = df[df['price'] != -1].copy()
+    df = convert_prices(df)
+    df.drop(['is_free', 'price_overview', 'packages', 'package_groups'], axis=1, inplace=True)
+    
+    return df
+
+@metrics.stage()
+def process_language_vectorized(df):
+    df = df[df['supported_languages'].notnull()].copy()
+    df['english'] = df['supported_languages'].str.contains('english', case=False, regex=False).astype('int64')
+    df.drop(['supported_languages'], axis=1, inplace=True)
+    
+    return df
+
+@metrics.stage()
+def process_cat_and_gen_vectorized(df):
+    df = df[(df['categories'].notnull()) & (df['genres'].notnull())].copy()
+    
+    for i in ['categories', 'genres']:
+        items = parse_nested(df[i]).explode().dropna()
+        descriptions = pd.json_normalize(items.tolist()).reindex(columns=['description'])['description']
+        descriptions.index = items.index
+        df[i] = descriptions.groupby(level=0, sort=False).agg(';'.join).reindex(df.index, fill_value='')
+        
+    return df
+
+@metrics.stage()
+def process_achiev_recom_and_desc_vectorized(df):
+    df.drop(['content_descriptors'], axis=1, inplace=True)
+    
+    for i in ['achievements', 'recommendations']:
+        total = df[i].str.extract(total_pattern, expand=False)
+        df[i] = pd.to_numeric(total).fillna(0).astype('int64')
+        
+    return df
+
+def get_support_data(df):
+    support_info = parse_nested(df['support_info'])
+    support_info_data = df[['steam_appid', 'website']].copy()
+    support_info_data['support_url'] = support_info.str.get('url')
+    support_info_data['support_email'] = support_info.str.get('email')
+    
+    return support_info_data
+
+@metrics.stage()
+def process_info_vectorized(df, export=False, append=False):
+    if export:
+        export_data(get_support_data(df), filename='support_data', append=append)
+    df.drop(['support_info', 'website'], axis=1, inplace=True)
+    
+    return df
+
+@metrics.stage()
+def process_requirements_vectorized(df, export=False, append=False):
+    # raw html is turned into typed hardware columns once here, so they can be queried without regex later
+    if export:
+        requirements_data = extract_requirements(df)
+        export_data(requirements_data, filename='requirements_data', append=append)
+    df.drop(['pc_requirements', 'mac_requirements', 'linux_requirements'], axis=1, inplace=True)
+    
+    return df
+
+@metrics.stage()
+def process_data_release_vectorized(df):
+    dates = df['release_date'].str.extract(date_pattern)
+    df['coming_soon'] = df['release_date'].str.contains(coming_soon_pattern, regex=True, na=False)
+    df['release_date'] = normalize_release_dates(dates[0].fillna(dates[1]).fillna(''))
+    df = df[df['release_date'].notnull() | df['coming_soon']]
+    
+    return df
+
+@metrics.stage()
+def process_vectorized(df, export=True, compact=False):
+    df = df.copy()
+    df = df.drop_duplicates()
+    df = drop_null_cols(df)
+    df = process_rows(df, export=export)
+    
+    if compact:
+        df = compact_dtypes(df)
+    
+    return df
+
+@metrics.stage()
+def process_rows(df, export=True, append=False):
+    # steps that only look at one row at a time, so they can run on any part of the data
+    df = process_name_type(df)
+    df = process_age(df)
+    df = process_platforms_vectorized(df)
+    df = process_price_vectorized(df)
+    df = process_language_vectorized(df)
+    df = process_dev_and_pub(df)
+    df = process_cat_and_gen_vectorized(df)
+    df = process_achiev_recom_and_desc_vectorized(df)
+    df = process_descriptions(df, export=export, append=append)
+    df = process_media(df, export=export, append=append)
+    df = process_info_vectorized(df, export=export, append=append)
+    df = process_requirements_vectorized(df, export=export, append=append)
+    df = process_data_release_vectorized(df)
+    
+    return df
+
+def check_vectorized(df):
+    # golden output check: vectorized engine has to give exactly the frame process gives
+    expected = process(df, export=False)
+    result = process_vectorized(df, export=False)
+    pd.testing.assert_frame_equal(result, expected)
+    
+    print("Vectorized output matches process: {} rows, {} columns".format(*result.shape))
+
+#%% release dates
+# date formats found on the store, commas are removed before matching, each class is parsed in one go
+release_date_formats = [
+    (r'^\d{1,2} [A-Za-z]+ \d{4}$', ['%d %b %Y', '%d %B %Y']),
+    (r'^[A-Za-z]+ \d{1,2} \d{4}$', ['%b %d %Y', '%B %d %Y']),
+    (r'^[A-Za-z]+ \d{4}$', ['%b %Y', '%B %Y']),
+    (r'^\d{4}-\d{1,2}-\d{1,2}$', ['%Y-%m-%d']),
+    (r'^\d{4}-\d{1,2}$', ['%Y-%m']),
+    (r'^\d{4}/\d{1,2}/\d{1,2}$', ['%Y/%m/%d']),
+    (r'^\d{1,2}\.\d{1,2}\.\d{4}$', ['%d.%m.%Y']),
+    (r'^\d{4}$', ['%Y'])]
+quarter_pattern = r'^[Qq]([1-4]) (\d{4})$'
+
+# month names and abbreviations of the store languages (lower case, without dots), matched as whole words
+# and replaced by the english abbreviation before the formats above are tried
+localized_months = {
+    'jan': ['january', 'janvier', 'janv', 'januar', 'jänner', 'jän', 'enero', 'ene', 'janeiro', 'gennaio', 'gen',
+            'stycznia', 'styczeń', 'sty', 'januari', 'января', 'январь', 'янв'],
+    'feb': ['february', 'février', 'févr', 'fevrier', 'fevr', 'februar', 'febrero', 'febr', 'fevereiro', 'fev',
+            'febbraio', 'lutego', 'luty', 'lut', 'februari', 'февраля', 'февраль', 'февр', 'фев'],
+    'mar': ['march', 'mars', 'märz', 'marzo', 'março', 'marca', 'marzec', 'maart', 'mrt', 'марта', 'март', 'мар'],
+    'apr': ['april', 'avril', 'avr', 'abril', 'abr', 'aprile', 'kwietnia', 'kwiecień', 'kwi', 'апреля', 'апрель', 'апр'],
+    'may': ['mai', 'mayo', 'maio', 'maggio', 'mag', 'maja', 'maj', 'mei', 'мая', 'май'],
+    'jun': ['june', 'juin', 'juni', 'junio', 'junho', 'giugno', 'giu', 'czerwca', 'czerwiec', 'cze', 'июня', 'июнь', 'июн'],
+    'jul': ['july', 'juillet', 'juil', 'juli', 'julio', 'julho', 'luglio', 'lug', 'lipca', 'lipiec', 'lip', 'июля', 'июль', 'июл'],
+    'aug': ['august', 'août', 'aout', 'augustus', 'agosto', 'ago', 'sierpnia', 'sierpień', 'sie', 'августа', 'август', 'авг'],
+    'sep': ['september', 'sept', 'septembre', 'septiembre', 'setembro', 'set', 'settembre', 'sett', 'września',
+            'wrzesień', 'wrz', 'сентября', 'сентябрь', 'сент', 'сен'],
+    'oct': ['october', 'octobre', 'oktober', 'octubre', 'outubro', 'out', 'ottobre', 'ott', 'okt', 'października',
+            'październik', 'paź', 'октября', 'октябрь', 'окт'],
+    'nov': ['november', 'novembre', 'noviembre', 'novembro', 'listopada', 'listopad', 'lis', 'ноября', 'ноябрь', 'нояб', 'ноя'],
+    'dec': ['december', 'décembre', 'déc', 'decembre', 'dezember', 'dez', 'diciembre', 'dic', 'dezembro', 'dicembre',
+            'grudnia', 'grudzień', 'gru', 'декабря', 'декабрь', 'дек']}
+month_replacements = {name: month for month, names in localized_months.items() for name in names}
+month_pattern = r'\b(?:{})\b'.format('|'.join(sorted(month_replacements, key=len, reverse=True)))
+
+# chinese, japanese and korean dates, like 2020年11月5日 or 2020년 11월 5일
+cjk_date_pattern = r'^(\d{4})\s*[年년]\s*(\d{1,2})\s*[月월](?:\s*(\d{1,2})\s*[日일])?$'
+
+# parsed date for every raw text seen so far, release dates repeat a lot
+release_date_cache = {}
+
+def normalize_date_texts(texts):
+    normalized = texts.str.replace(',', '', regex=False).str.strip().str.lower()
+    
+    cjk = normalized.str.extract(cjk_date_pattern)
+    mask = cjk[0].notnull()
+    normalized[mask] = cjk.loc[mask, 0] + '-' + cjk.loc[mask, 1] + ('-' + cjk.loc[mask, 2]).fillna('')
+    
+    # '5. nov. 2020' and '5 de nov. de 2020' come down to '5 nov 2020', numeric dates keep their dots
+    normalized = normalized.str.replace(r'(?<=[^\W\d_])\.', '', regex=True)
+    normalized = normalized.str.replace(r'^(\d{1,2})\.\s', r'\1 ', regex=True)
+    normalized = normalized.str.replace(r'\s+de\s+', ' ', regex=True)
+    normalized = normalized.str.replace(month_pattern, lambda match: month_replacements[match.group(0)], regex=True)
+    
+    return normalized.str.replace(r'\s+', ' ', regex=True).str.strip()
+
+def parse_release_date_classes(texts):
+    normalized = normalize_date_texts(texts)
+    parsed = pd.Series(pd.NaT, index=texts.index, dtype='datetime64[ns]')
+    
+    for pattern, formats in release_date_formats:
+        mask = normalized.str.match(pattern) & parsed.isnull()
+        
+        for date_format in formats:
+            todo = mask & parsed.isnull()
+            if todo.any():
+                parsed[todo] = pd.to_datetime(normalized[todo], format=date_format, errors='coerce')
+                
+    # quarters are dated on the first day of the quarter
+    quarters = normalized.str.extract(quarter_pattern)
+    mask = quarters[0].notnull() & parsed.isnull()
+    if mask.any():
+        months = (quarters.loc[mask, 0].astype(int) - 1) * 3 + 1
+        parsed[mask] = pd.to_datetime(quarters.loc[mask, 1] + '-' + months.astype(str) + '-01', format='%Y-%m-%d')
+        
+    return parsed
+
+def normalize_release_dates(dates):
+    uniques = pd.Series(dates.dropna().unique())
+    new = uniques[~uniques.isin(list(release_date_cache))]
+    
+    # only texts never seen before are classified and parsed
+    if len(new):
+        parsed = parse_release_date_classes(new)
+        release_date_cache.update(zip(new, parsed))
+        
+    return pd.to_datetime(dates.map(release_date_cache))
+
+#%% requirements parsing
+requirement_platforms = ['pc', 'mac', 'linux']
+requirement_fields = ['os', 'cpu', 'ram_mb', 'gpu', 'directx', 'storage_mb']
+
+# labels steam uses for the same field, compared lower case without '*' and ':'
+requirement_labels = {
+    'os': 'os', 'operating system': 'os', 'supported os': 'os',
+    'processor': 'cpu', 'cpu': 'cpu',
+    'memory': 'ram_mb', 'ram': 'ram_mb', 'system memory': 'ram_mb',
+    'graphics': 'gpu', 'video card': 'gpu', 'video': 'gpu', 'graphics card': 'gpu', 'gpu': 'gpu',
+    'directx': 'directx', 'directx version': 'directx',
+    'storage': 'storage_mb', 'hard drive': 'storage_mb', 'hard disk space': 'storage_mb',
+    'hard disk': 'storage_mb', 'disk space': 'storage_mb', 'hdd': 'storage_mb'}
+
+# html is split into lines at breaks and list items, each line without tags is read as 'Label: value'
+line_break_pattern = re.compile(r'<br\s*/?>|</?li>|</?p>|</?ul[^>]*>|\n', re.I)
+tag_pattern = re.compile(r'<[^>]+>')
+label_pattern = re.compile(r'^\s*([^:]{1,40}?)\s*:\s*(.+)$', re.S)
+size_pattern = re.compile(r'(\d+(?:[.,]\d+)?)\s*(tb|gb|mb|kb|g|m)\b', re.I)
+version_pattern = re.compile(r'(\d+(?:\.\d+)?)')
+size_units = {'tb': 1024 * 1024, 'gb': 1024, 'g': 1024, 'mb': 1, 'm': 1, 'kb': 1 / 1024}
+
+# parsed requirements by content hash, many apps share the same requirements text
+requirements_cache = {}
+
+def parse_size_mb(text):
+    match = size_pattern.search(text)
+    
+    if match is None:
+        return None
+    
+    return round(float(match.group(1).replace(',', '.')) * size_units[match.group(2).lower()])
+
+def parse_requirements(raw):
+    requirements = parse_value(raw)
+    result = dict.fromkeys(requirement_fields)
+    
+    # apps without requirements come as an empty list
+    if not isinstance(requirements, dict) or not isinstance(requirements.get('minimum'), str):
+        return result
+    
+    for line in line_break_pattern.split(requirements['minimum']):
+        match = label_pattern.match(tag_pattern.sub('', line))
+        field = None
+        
+        # 'Minimum: OS: Windows 7' has the real label after the heading
+        while match is not None and field is None:
+            label, value = match.group(1), match.group(2).strip()
+            field = requirement_labels.get(label.lower().replace('*', '').strip())
+            match = label_pattern.match(value) if field is None else match
+        
+        if field is None or result[field] is not None or not value:
+            continue
+        
+        if field in ('ram_mb', 'storage_mb'):
+            result[field] = parse_size_mb(value)
+        elif field == 'directx':
+            match = version_pattern.search(value)
+            result[field] = float(match.group(1)) if match else None
+        else:
+            result[field] = value
+            
+    return result
+
+def parse_requirements_cached(raw):
+    key = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+    
+    if key not in requirements_cache:
+        requirements_cache[key] = parse_requirements(raw)
+        
+    return requirements_cache[key]
+
+@metrics.stage()
+def extract_requirements(df):
+    requirements_data = df[['steam_appid']].copy()
+    
+    for platform in requirement_platforms:
+        raw = df[platform + '_requirements']
+        uniques = raw.dropna().unique()
+        
+        # every distinct text is parsed once, rows then pick up their result by lookup
+        parsed = pd.DataFrame([parse_requirements_cached(value) for value in uniques],
+                              index=uniques, columns=requirement_fields)
+        parsed = parsed.reindex(raw.to_numpy())
+        parsed.index = df.index
+        
+        for field in requirement_fields:
+            requirements_data[platform + '_' + field] = parsed[field]
+            
+        for field in ['ram_mb', 'storage_mb']:
+            requirements_data[platform + '_' + field] = requirements_data[platform + '_' + field].astype('Int64')
+        requirements_data[platform + '_directx'] = requirements_data[platform + '_directx'].astype('float64')
+            
+    return requirements_data
+
+#%% compact dtypes
+# repeated strings become categoricals, ';' joined multi value fields become sparse one-hot columns
+category_columns = ['developer', 'publisher', 'platforms', 'currency']
+multi_value_columns = ['categories', 'genres']
+count_columns = ['steam_appid', 'achievements', 'recommendations', 'english']
+
+def downcast_counts(series):
+    values = series.dropna()
+    
+    # counts with fractions are left alone, they are not counts
+    if not (values == values.round()).all():
+        return series
+    
+    # smallest nullable integer dtype holding the counts, so missing counts do not turn the column into floats
+    dtypes = ['uint8', 'uint16', 'uint32', 'uint64'] if values.empty or values.min() >= 0 else ['int8', 'int16', 'int32', 'int64']
+    for dtype in dtypes:
+        if values.empty or (np.iinfo(dtype).min <= values.min() and values.max() <= np.iinfo(dtype).max):
+            return series.astype(dtype.replace('uint', 'UInt').replace('int', 'Int'))
+    
+    return series
+
+def encode_multi_value(series, prefix):
+    values = series.str.split(';').explode()
+    values = values[values.notnull() & (values != '')]
+    
+    codes, uniques = pd.factorize(values, sort=True)
+    positions = series.index.get_indexer(values.index)
+    
+    columns = {}
+    for code, value in enumerate(uniques):
+        dense = np.zeros(len(series), dtype='uint8')
+        dense[positions[codes == code]] = 1
+        columns[prefix + '_' + value] = pd.arrays.SparseArray(dense, fill_value=0)
+        
+    return pd.DataFrame(columns, index=series.index)
+
+@metrics.stage()
+def compact_dtypes(df):
+    df = df.copy()
+    
+    for column in category_columns:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+            
+    for column in count_columns:
+        if column in df.columns:
+            df[column] = downcast_counts(df[column])
+            
+    for column in ['price', 'price_original']:
+        if column in df.columns:
+            df[column] = pd.to_numeric(df[column], downcast='float')
+    
+    for column in multi_value_columns:
+        if column in df.columns:
+            one_hot = encode_multi_value(df[column], column)
+            df = pd.concat([df.drop(column, axis=1), one_hot], axis=1)
+            
+    return df
+
+def memory_report(before, after):
+    before_bytes = before.memory_usage(index=False, deep=True)
+    after_bytes = after.memory_usage(index=False, deep=True)
+    
+    # one-hot columns are counted towards the column they were made of
+    owners = pd.Series(after_bytes.index, index=after_bytes.index)
+    for column in multi_value_columns:
+        owners[owners.str.startswith(column + '_')] = column
+    after_bytes = after_bytes.groupby(owners.values).sum()
+    
+    report = pd.DataFrame({'before': before_bytes, 'after': after_bytes}).fillna(0).astype('int64')
+    report['ratio'] = (report['after'] / report['before']).round(3)
+    report.loc['total'] = [report['before'].sum(), report['after'].sum(), round(report['after'].sum() / report['before'].sum(), 3)]
+    
+    print(report)
+    
+    return report
+
+#%% dimension tables
+# multi value fields interned into int32 keyed dimension tables (id, value), apps point to their values through
+# bridge tables (steam_appid, id) sorted by id, so a filter on a genre or developer is two binary searches
+dimension_fields = {'developer': 'developers', 'publisher': 'publishers', 'categories': 'categories', 'genres': 'genres'}
+
+def build_dimension(series, appids):
+    # every value of a multi developer (or genre, ...) app gets its own bridge row
+    values = series.str.split(';').explode()
+    values = values[values.notnull() & (values != '')]
+    
+    codes, uniques = pd.factorize(values, sort=True)
+    positions = series.index.get_indexer(values.index)
+    
+    dimension = pd.DataFrame({'id': np.arange(len(uniques), dtype='int32'), 'value': uniques})
+    bridge = pd.DataFrame({'steam_appid': appids[positions].astype('int32'), 'id': codes.astype('int32')})
+    bridge = bridge.sort_values(['id', 'steam_appid'], kind='stable').reset_index(drop=True)
+    
+    return dimension, bridge
+
+@metrics.stage()
+def normalize_dimensions(df):
+    # returns the frame without the multi value columns and a dict of dimension and bridge tables by name
+    tables = {}
+    appids = df['steam_appid'].to_numpy()
+    
+    for column, name in dimension_fields.items():
+        if column in df.columns:
+            tables[name], tables['app_' + name] = build_dimension(df[column].astype(object), appids)
+    
+    return df.drop([column for column in dimension_fields if column in df.columns], axis=1), tables
+
+def get_dimension_id(tables, name, value):
+    # dimension values are sorted, so the id is found by binary search
+    values = tables[name]['value'].to_numpy(dtype=object)
+    position = np.searchsorted(values, value)
+    
+    if position < len(values) and values[position] == value:
+        return int(tables[name]['id'].iloc[position])
+    
+    return None
+
+def get_appids_with(tables, name, value):
+    # appids of apps with the value, e.g. get_appids_with(tables, 'genres', 'Action')
+    dimension_id = get_dimension_id(tables, name, value)
+    bridge = tables['app_' + name]
+    
+    if dimension_id is None:
+        return bridge['steam_appid'].to_numpy()[:0]
+    
+    ids = bridge['id'].to_numpy()
+    start, stop = np.searchsorted(ids, [dimension_id, dimension_id + 1])
+    
+    return bridge['steam_appid'].to_numpy()[start:stop]
+
+#%% streaming cleaning
+# raw csv is read as text in streaming mode so duplicate rows hash the same in every chunk, types are restored after
+def infer_types(df):
+    for column in df.columns:
+        values = df[column].dropna()
+        
+        if len(values) == 0:
+            continue
+        
+        if values.isin(['True', 'False']).all():
+            df[column] = df[column].map({'True': True, 'False': False})
+            continue
+        
+        numeric = pd.to_numeric(df[column], errors='coerce')
+        if numeric.notnull().sum() == len(values):
+            df[column] = numeric
+            
+    return df
+
+def find_first_rows(df, seen):
+    # rows are compared by 64 bit hashes, seen keeps hashes of every row met so far (8 bytes per row)
+    hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    first = ~pd.Series(hashes).duplicated().to_numpy() & ~np.isin(hashes, seen)
+    
+    return first, np.union1d(seen, hashes)
+
+def iter_raw_chunks(name, fmt, chunksize):
+    if fmt == 'csv':
+        return storage.iter_table(export_path, name, fmt=fmt, chunksize=chunksize, dtype=str)
+    
+    return storage.iter_table(export_path, name, fmt=fmt, chunksize=chunksize)
+
+def scan_raw_data(name, fmt='csv', chunksize=20000, thresh=0.5):
+    # first pass: count unique rows and their non null values, to know which columns drop_null_cols would drop
+    seen = np.empty(0, dtype='uint64')
+    non_null = None
+    total = 0
+    
+    for chunk in iter_raw_chunks(name, fmt, chunksize):
+        first, seen = find_first_rows(chunk, seen)
+        counts = chunk[first].notnull().sum()
+        non_null = counts if non_null is None else non_null.add(counts, fill_value=0)
+        total += first.sum()
+        
+    keep_columns = list(non_null.index[non_null >= total * thresh])
+    print("Scanned {} unique rows, keeping {} of {} columns".format(total, len(keep_columns), len(non_null)))
+    
+    return keep_columns
+
+@metrics.stage()
+def process_streaming(name, output_name, fmt='csv', chunksize=20000, thresh=0.5, export=True):
+    keep_columns = scan_raw_data(name, fmt, chunksize, thresh)
+    
+    # second pass: drop duplicates and null columns found in the first pass, clean and append chunk by chunk
+    seen = np.empty(0, dtype='uint64')
+    rows_in, rows_out = 0, 0
+    
+    for i, chunk in enumerate(iter_raw_chunks(name, fmt, chunksize)):
+        first, seen = find_first_rows(chunk, seen)
+        chunk = chunk.loc[first, keep_columns]
+        
+        if fmt == 'csv':
+            chunk = infer_types(chunk)
+            
+        rows_in += len(chunk)
+        chunk = process_rows(chunk, export=export, append=i > 0)
+        export_data(chunk, output_name, append=i > 0)
+        rows_out += len(chunk)
+        
+        print("Chunk {}: {} rows cleaned, {} written so far".format(i, len(chunk), rows_out))
+        
+    print("Streaming cleaning complete: {} unique rows in, {} rows out".format(rows_in, rows_out))
+
+#%% parallel cleaning
+def process_partition(in_path, out_path, part_export_path, export):
+    global export_path, export_format, export_key, side_table_writer
+    
+    # runs in a worker process: side tables go to this partition's own folder, in row order
+    # writer threads of the parent are not copied into the worker, so tables are written directly
+    export_path, export_format, export_key = part_export_path, 'parquet', None
+    side_table_writer = None
+    
+    df = storage.read_frame_ipc(in_path)
+    df = process_rows(df, export=export)
+    storage.write_frame_ipc(df, out_path)
+    
+    # pool workers never run exit handlers, so their metrics (own file per pid) are written after every partition
+    if metrics.metrics_path is not None:
+        metrics.write_metrics()
+    
+    return out_path
+
+@metrics.stage()
+def process_parallel(df, export=True, workers=None):
+    workers = workers or os.cpu_count()
+    
+    # duplicates and null columns need the whole frame, everything after that is done per partition
+    df = df.drop_duplicates()
+    df = drop_null_cols(df)
+    
+    # partitions are passed as arrow files, in shared memory when the system has it
+    tmp_dir = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    
+    try:
+        futures = []
+        
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for k, bounds in enumerate(np.array_split(np.arange(len(df)), workers)):
+                if len(bounds) == 0:
+                    continue
+                
+                in_path = os.path.join(tmp_dir, 'in_{}.arrow'.format(k))
+                out_path = os.path.join(tmp_dir, 'out_{}.arrow'.format(k))
+                part_export_path = os.path.join(tmp_dir, 'export_{}'.format(k))
+                os.makedirs(part_export_path)
+                
+                storage.write_frame_ipc(df.iloc[bounds[0]:bounds[-1] + 1], in_path)
+                futures.append((part_export_path, executor.submit(process_partition, in_path, out_path, part_export_path, export)))
+                
+            # partitions are put back together in their original order, whichever worker finished first
+            result = pd.concat([storage.read_frame_ipc(future.result()) for part_export_path, future in futures])
+            
+        if export:
+            for name in side_tables:
+                side_table = pd.concat([storage.read_table(part_export_path, name, fmt='parquet')
+                                        for part_export_path, future in futures])
+                export_data(side_table, name)
+    finally:
+        shutil.rmtree(tmp_dir)
+        
+    return result
+
+#%% cached stages
+# process_vectorized as a graph of stages cached under export_path (see pipeline.py), after editing one step
+# only that step and the ones after it run again, side tables branch off before the step dropping their columns
+stage_cache_folder = 'stage_cache'
+
+def read_raw_data(name, fmt):
+    return storage.read_table(export_path, name, fmt=fmt)
+
+def drop_duplicates_and_null_cols(df, thresh=0.5):
+    return drop_null_cols(df.drop_duplicates(), thresh)
+
+def get_cleaning_stages(raw_name='steam_app_data', raw_format='csv', thresh=0.5):
+    stage = pipeline.make_stage
+    nested = [parse_nested, parse_value]
+    release_settings = {'date_pattern': date_pattern, 'coming_soon_pattern': coming_soon_pattern,
+                        'release_date_formats': release_date_formats, 'quarter_pattern': quarter_pattern}
+    requirements_settings = {'requirement_fields': requirement_fields, 'requirement_labels': requirement_labels,
+                             'patterns': [line_break_pattern, tag_pattern, label_pattern, size_pattern, version_pattern],
+                             'size_units': size_units}
+    
+    return [
+        stage('raw', read_raw_data, params={'name': raw_name, 'fmt': raw_format},
+              files=[storage.get_table_path(export_path, raw_name, raw_format)]),
+        stage('deduplicated', drop_duplicates_and_null_cols, ['raw'], params={'thresh': thresh}, code=[drop_null_cols]),
+        stage('name_type', process_name_type, ['deduplicated']),
+        stage('age', process_age, ['name_type']),
+        stage('platforms', process_platforms_vectorized, ['age'],
+              settings={'platform_names': platform_names, 'platform_pattern': platform_pattern}),
+        stage('price', process_price_vectorized, ['platforms'], code=[convert_prices, get_exchange_rates, load_exchange_rates],
+              settings={'currency_pattern': currency_pattern, 'initial_pattern': initial_pattern,
+                        'exchange_rates_date': exchange_rates_date}, files=[exchange_rates_path]),
+        stage('language', process_language_vectorized, ['price']),
+        stage('dev_and_pub', process_dev_and_pub, ['language'], code=nested),
+        stage('cat_and_gen', process_cat_and_gen_vectorized, ['dev_and_pub'], code=nested),
+        stage('achiev_recom_and_desc', process_achiev_recom_and_desc_vectorized, ['cat_and_gen'],
+              settings={'total_pattern': total_pattern}),
+        stage('descriptions', process_descriptions, ['achiev_recom_and_desc']),
+        stage('media', process_media, ['descriptions']),
+        stage('info', process_info_vectorized, ['media']),
+        stage('requirements', process_requirements_vectorized, ['info']),
+        stage('data_release', process_data_release_vectorized, ['requirements'],
+              code=[normalize_release_dates, parse_release_date_classes], settings=release_settings),
+        
+        # side tables only select from the frame they branch off, so they get it without a copy
+        stage('description_data', get_description_data, ['achiev_recom_and_desc'], copy_inputs=False),
+        stage('media_data', get_media_data, ['descriptions'], copy_inputs=False),
+        stage('support_data', get_support_data, ['media'], code=nested, copy_inputs=False),
+        stage('requirements_data', extract_requirements, ['info'],
+              code=[parse_requirements_cached, parse_requirements, parse_size_mb], settings=requirements_settings,
+              copy_inputs=False),
+        ]
+
+def read_exported_keys(cache_path):
+    path = os.path.join(cache_path, 'exported_keys.json')
+    
+    if not os.path.exists(path):
+        return {}
+    
+    with open(path) as f:
+        return json.load(f)
+
+def write_exported_keys(cache_path, exported_keys):
+    with open(os.path.join(cache_path, 'exported_keys.json'), 'w') as f:
+        json.dump(exported_keys, f)
+
+def process_cached(raw_name='steam_app_data', raw_format='csv', export=True, cache_path=None):
+    cache_path = cache_path or os.path.join(export_path, stage_cache_folder)
+    stages = get_cleaning_stages(raw_name, raw_format)
+    exports = []
+    
+    # a side table is exported again only when its result changed since it was last written
+    if export:
+        plan = pipeline.plan_stages(stages, cache_path, side_tables)
+        exported_keys = read_exported_keys(cache_path)
+        exports = [name for name in side_tables
+                   if exported_keys.get(name) != plan[name]['key'] or not storage.table_exists(export_path, name, export_format)]
+    
+    # side tables are taken first, the frame they branch off is then handed on to the main chain without a copy
+    outputs, status = pipeline.run_stages(stages, cache_path, exports + ['data_release'])
+    
+    for name in exports:
+        export_data(outputs[name], name)
+        exported_keys[name] = plan[name]['key']
+        
+    if exports:
+        write_exported_keys(cache_path, exported_keys)
+    
+    return outputs['data_release']
+
+def export_database(df, writer=None, dimension_tables=None):
+    # cleaned data and side tables in one sqlite file with indexes and name search, queried through analytics.py
+    # multi value columns are stored once in dimension and bridge tables instead of the main table,
+    # df is normalized here unless it comes with its tables from normalize_dimensions
+    if dimension_tables is None:
+        df, dimension_tables = normalize_dimensions(df)
+    
+    storage.write_table(df, export_path, 'initial_processing', fmt='sqlite')
+    
+    for name in side_tables:
+        side_table = get_side_table(writer, name) if writer is not None else storage.read_table(export_path, name, fmt=export_format)
+        storage.write_table(side_table, export_path, name, fmt='sqlite')
+    
+    # analytics filters developers, publishers, categories and genres by id through these
+    for name, table in dimension_tables.items():
+        storage.write_table(table, export_path, name, fmt='sqlite')
+        
+    print("Exported database to '{}'".format(storage.get_table_path(export_path, None, fmt='sqlite')))
+
 def print_steam_links(df):
     url_base = "https://store.steampowered.com/app/"
     
@@ -187,8 +1016,9 @@ def print_steam_links(df):
 #%% data cleaning
 if __name__ == '__main__':
     
-    # read in downloaded data
-    raw_steam_data = pd.read_csv('/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/2_files/steam_app_data.csv')
+    # read in downloaded data, raw_format='parquet' reads the partitioned dataset written by the downloader
+    raw_format = 'csv'
+    raw_steam_data = storage.read_table(export_path, 'steam_app_data', fmt=raw_format)
     
     # print out number of rows and columns
     print('Rows:', raw_steam_data.shape[0])
@@ -215,8 +1045,26 @@ if __name__ == '__main__':
     #print('Duplicate rows to remove: ', duplicate_rows.shape[0])    
     
     print(raw_steam_data.shape)
-    initial_processing = process(raw_steam_data)
+    
+    # side tables are written to parquet in background threads while cleaning goes on, the frames are kept
+    # as handles so later steps use them without reading the files back
+    side_table_writer = start_side_table_writer(fmt='parquet')
+    
+    # golden check on a sample of real data, test_cleaning.py runs it on synthetic repr and json data
+    # check_vectorized(raw_steam_data.sample(5000, random_state=0))
+    initial_processing = process_vectorized(raw_steam_data)
+    
+    # while working on a single step, cached stages recompute only that step and the ones after it
+    # initial_processing = process_cached('steam_app_data', raw_format)
     print(initial_processing.shape)
+    
+    # for data larger than memory clean in chunks instead, output is appended to initial_processing as it goes
+    # keep_frames=False makes side table handles read the written tables back instead of holding every chunk
+    # side_table_writer = start_side_table_writer(fmt='parquet', keep_frames=False)
+    # process_streaming('steam_app_data', 'initial_processing', fmt=raw_format, chunksize=20000)
+    
+    # or spread the per row steps over all cores (needs pyarrow), gives the same frame as process_vectorized
+    # initial_processing = process_parallel(raw_steam_data, workers=os.cpu_count())
 
     # after initial process we can check if 'age' and 'platforms' works well
     #initial_processing['required_age'].value_counts().sort_index()
@@ -228,9 +1076,18 @@ if __name__ == '__main__':
     #initial_processing_wrong_price = initial_processing[initial_processing['price_overview'].isnull() & initial_processing['is_free'] == False]
     #print_steam_links(initial_processing_wrong_price[:5])
 
-    initial_processing[initial_processing['name'].str.contains('Counter-Strike')].head(10)
+    # developers, publishers, categories and genres as int32 dimension and bridge tables, multi developer apps included
+    normalized_processing, dimension_data = normalize_dimensions(initial_processing)
+    get_appids_with(dimension_data, 'genres', 'Action')[:10]
+    
+    # lookups go to an indexed sqlite copy instead of scanning the whole frame, stored with compact dtypes
+    export_database(compact_dtypes(normalized_processing), side_table_writer, dimension_data)
+    
+    analytics.find_apps(export_path, name='Counter-Strike', limit=10)
+    analytics.find_apps(export_path, genre='Action', developer='Valve', limit=10)
+    #analytics.get_dimension_values(export_path, 'developer').head(20)
 
-    print_steam_links(initial_processing[initial_processing['name'].str.contains('Counter-Strike')])
+    analytics.print_steam_links(export_path, name='Counter-Strike')
 
     # comparation between price and package_groups as we still missing information about '-1' price games
     #initial_processing[initial_processing['price']==-1].shape[0]
@@ -275,21 +1132,29 @@ if __name__ == '__main__':
     #initial_processing[['detailed_description', 'about_the_game', 'short_description']].isnull().sum()
     #initial_processing[initial_processing['detailed_description'].isnull()]
     #initial_processing[initial_processing['detailed_description'].str.len()<=20]
-    pd.read_csv('/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/2_files/description_data.csv').head()
+    get_side_table(side_table_writer, 'description_data').head()
 
     # Exporting data which is not useful for now: Media
     #for i in ['header_image', 'screenshots', 'background']:
     #    print(i+':', initial_processing[i].isnull().sum())
-    pd.read_csv('/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/2_files/media_data.csv').head()
+    get_side_table(side_table_writer, 'media_data').head()
 
     # Memory usage information
     raw_steam_data.info(verbose=False, memory_usage="deep")
     initial_processing.info(verbose=False, memory_usage="deep")
+    
+    # same data with categoricals, sparse one-hot categories/genres and downcast counts
+    compact_processing = compact_dtypes(initial_processing)
+    memory_report(initial_processing, compact_processing)
+    
+    # multi value columns moved out to dimension and bridge tables
+    memory_report(initial_processing, normalized_processing)
+    print('Dimension and bridge tables:', sum(table.memory_usage(index=False, deep=True).sum() for table in dimension_data.values()))
 
     # Exporting data which is not useful for now: Info
     #initial_processing[['name', 'website', 'support_info']][50:70]
     #initial_processing['support_info'].value_counts()
-    pd.read_csv('/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/2_files/support_data.csv').head()
+    get_side_table(side_table_writer, 'support_data').head()
 
     # Exporting data which is not useful for now: Requirements
     #initial_processing['pc_requirements'].iloc[[0,2000,15000]]
@@ -304,11 +1169,18 @@ if __name__ == '__main__':
     #print(ppp['clean_pcr'][1].values())
 
     initial_processing.head()
-    pd.read_csv('/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/2_files/requirements_data.csv').head()
+    get_side_table(side_table_writer, 'requirements_data').head()
 
     # Last tests to make sure file is ready to save!
     #initial_processing.isnull().sum()
     #initial_processing[initial_processing['release_date'] > '2020-02-02']
-    initial_processing.to_csv('/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/2_files/initial_processing.csv')
+    # exported with the compact schema: categoricals, downcast counts and one-hot categories/genres columns
+    export_data(compact_processing, 'initial_processing')
+    #for name, table in dimension_data.items():
+    #    storage.write_table(table, export_path, name, fmt=export_format)
+    close_side_table_writer(side_table_writer)
+    
+    # time, rows dropped and memory per step, collected only when STEAM_METRICS names a file (see metrics.py)
+    metrics.print_stages()
 
 #%%    
\ No newline at end of file
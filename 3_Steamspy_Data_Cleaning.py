@@ -7,3 +7,248 @@ Created on Wed Sep 20 19:24:05 2023
 This file is about to celaning data from Steamspy service
 """
 
+#%% third-party imports
+import numpy as np
+import pandas as pd
+
+#%% local imports
+import metrics
+import storage
+from storage import parse_nested
+
+#%% customisations
+pd.options.display.max_columns = 100
+
+# raw steamspy data comes from the downloader, cleaned and merged tables go next to the cleaned store data
+import_path = '/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/1_files/'
+export_path = '/home/wroszu/Python_Projects/Connected-with-repo/Steam-Data-Analysis-FILES/2_files/'
+export_format = 'csv'
+
+# always empty or always 0 in the current api
+steamspy_drop_columns = ['score_rank', 'userscore']
+count_columns = ['positive', 'negative', 'average_forever', 'average_2weeks', 'median_forever', 'median_2weeks', 'ccu', 'discount']
+
+# owners come as a range of text numbers, like '20,000 .. 50,000'
+owners_pattern = r'^\s*([\d,]+)\s*\.\.\s*([\d,]+)\s*$'
+
+# tag votes become one sparse column per tag, most apps have a handful of the few hundred tags
+tag_prefix = 'tag'
+tag_dtype = pd.SparseDtype('int32', 0)
+
+# steamspy fields added to the store data, the rest (name, developer, publisher, ...) is there already
+merge_columns = ['positive', 'negative', 'owners_min', 'owners_max', 'average_forever', 'average_2weeks',
+                 'median_forever', 'median_2weeks', 'ccu', 'price_usd', 'initial_price_usd', 'discount']
+
+#%% functions definition
+@metrics.stage()
+def process_owners(df):
+    bounds = df['owners'].str.extract(owners_pattern)
+
+    for i, column in enumerate(['owners_min', 'owners_max']):
+        df[column] = pd.to_numeric(bounds[i].str.replace(',', '', regex=False)).astype('Int64')
+
+    df.drop(['owners'], axis=1, inplace=True)
+
+    return df
+
+@metrics.stage()
+def process_counts(df):
+    for column in count_columns:
+        df[column] = pd.to_numeric(df[column], errors='coerce').astype('Int64')
+
+    return df
+
+@metrics.stage()
+def process_prices(df):
+    # steamspy prices are us cents, the store data holds its own price in PLN
+    df['price_usd'] = pd.to_numeric(df['price'], errors='coerce') / 100
+    df['initial_price_usd'] = pd.to_numeric(df['initialprice'], errors='coerce') / 100
+    df.drop(['price', 'initialprice'], axis=1, inplace=True)
+
+    return df
+
+def encode_tags(series):
+    # steamspy sends an empty list instead of an empty dict for apps without tags
+    tags = parse_nested(series)
+    items = [(position, tag, votes) for position, value in enumerate(tags) if isinstance(value, dict)
+             for tag, votes in value.items()]
+
+    positions = np.array([item[0] for item in items], dtype='int64')
+    votes = np.array([item[2] for item in items], dtype='int32')
+    codes, uniques = pd.factorize(pd.Series([item[1] for item in items], dtype=object), sort=True)
+
+    # items grouped by tag once, each column then takes its slice instead of scanning all items again
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+
+    columns = {}
+    for code, tag in enumerate(uniques):
+        selected = order[bounds[code]:bounds[code + 1]]
+        dense = np.zeros(len(series), dtype='int32')
+        dense[positions[selected]] = votes[selected]
+        columns[tag_prefix + '_' + tag] = pd.arrays.SparseArray(dense, fill_value=0)
+
+    return pd.DataFrame(columns, index=series.index)
+
+@metrics.stage()
+def process_tags(df):
+    tags = encode_tags(df['tags'])
+    df = pd.concat([df.drop(['tags'], axis=1), tags], axis=1)
+
+    return df
+
+def get_tag_columns(df):
+    return [column for column in df.columns if column.startswith(tag_prefix + '_')]
+
+def restore_tags(df):
+    # tag columns come back dense from csv, or with NaN where frames with different tags were put together
+    for column in get_tag_columns(df):
+        if df[column].dtype != tag_dtype:
+            df[column] = df[column].fillna(0).astype(tag_dtype)
+
+    return df
+
+def sort_by_key(df, key):
+    # every lookup below is a binary search, so tables are kept sorted by their key
+    if df[key].is_monotonic_increasing:
+        return df
+
+    return df.sort_values(key, kind='stable').reset_index(drop=True)
+
+@metrics.stage()
+def process_steamspy(df):
+    df = df.copy()
+
+    # a refresh appends apps downloaded again, the last download of an app wins
+    df['appid'] = pd.to_numeric(df['appid'], errors='coerce')
+    df = df[df['appid'].notnull()].drop_duplicates('appid', keep='last').copy()
+    df['appid'] = df['appid'].astype('int64')
+
+    df = df.drop(steamspy_drop_columns, axis=1)
+    df = process_owners(df)
+    df = process_counts(df)
+    df = process_prices(df)
+    df = process_tags(df)
+
+    return sort_by_key(df, 'appid')
+
+#%% sorted merge
+def find_sorted(sorted_keys, values):
+    # position of every value in sorted_keys, -1 where it is missing
+    if len(sorted_keys) == 0:
+        return np.full(len(values), -1, dtype='int64')
+
+    positions = np.minimum(np.searchsorted(sorted_keys, values), len(sorted_keys) - 1)
+
+    return np.where(sorted_keys[positions] == values, positions, -1)
+
+def to_nullable(series):
+    # numpy ints and bools can't hold a missing value, store apps steamspy doesn't know need one
+    if not isinstance(series.dtype, np.dtype):
+        return series
+
+    if series.dtype.kind == 'b':
+        return series.astype('boolean')
+
+    if series.dtype.kind in 'iu':
+        return series.astype('{}{}'.format('Int' if series.dtype.kind == 'i' else 'UInt', series.dtype.itemsize * 8))
+
+    return series
+
+def take_columns(df, columns, positions):
+    # rows are picked by position column by column, -1 gives a missing value (0 for sparse tag votes)
+    taken = {}
+
+    for column in columns:
+        array = to_nullable(df[column]).array
+        fill_value = array.fill_value if isinstance(array, pd.arrays.SparseArray) else None
+        taken[column] = array.take(positions, allow_fill=True, fill_value=fill_value)
+
+    return taken
+
+@metrics.stage()
+def merge_sorted(store, steamspy, store_key='steam_appid', key='appid'):
+    # store rows find their steamspy row by binary search on sorted appids, no hash table over both frames
+    # and no copy of steamspy is made, only the picked values of the merged columns are new
+    steamspy = sort_by_key(steamspy, key)
+    columns = merge_columns + get_tag_columns(steamspy)
+    positions = find_sorted(steamspy[key].to_numpy(), store[store_key].to_numpy())
+
+    added = pd.DataFrame(take_columns(steamspy, columns, positions), index=store.index)
+
+    return pd.concat([store, added], axis=1)
+
+def upsert_sorted(table, rows, key, keys=None):
+    # rows replace table rows with the same key, keys without a row in rows are removed from the table
+    # the binary search needs the table sorted, merged tables keep the row order of the store data
+    table = sort_by_key(table, key)
+    keys = rows[key].to_numpy() if keys is None else np.asarray(keys)
+    positions = find_sorted(table[key].to_numpy(), keys)
+
+    keep = np.ones(len(table), dtype=bool)
+    keep[positions[positions >= 0]] = False
+
+    table = pd.concat([table[keep], rows], ignore_index=True)
+
+    return sort_by_key(restore_tags(table), key)
+
+@metrics.stage()
+def refresh_merged(merged, store, steamspy, appids, store_key='steam_appid', key='appid'):
+    # only the given apps are merged again, then spliced into the merged table in appid order
+    appids = np.unique(np.asarray(appids))
+    store = sort_by_key(store, store_key)
+
+    positions = find_sorted(store[store_key].to_numpy(), appids)
+    rows = merge_sorted(store.iloc[positions[positions >= 0]], steamspy, store_key, key)
+
+    return upsert_sorted(merged, rows, store_key, keys=appids)
+
+def read_cleaned(name):
+    return restore_tags(storage.read_table(export_path, name, fmt=export_format))
+
+def export_data(df, filename, key):
+    filepath = storage.write_table(df, export_path, filename, fmt=export_format, key=key)
+
+    print("Exported {} to '{}'".format(filename, filepath))
+
+#%% data cleaning
+if __name__ == '__main__':
+
+    # read in downloaded data, raw_format='parquet' reads the partitioned dataset written by the downloader
+    raw_format = 'csv'
+    raw_steamspy_data = storage.read_table(import_path, 'steamspy_data', fmt=raw_format)
+
+    print('Rows:', raw_steamspy_data.shape[0])
+    print('Columns:', raw_steamspy_data.shape[1])
+
+    steamspy_data = process_steamspy(raw_steamspy_data)
+    print(steamspy_data.shape)
+
+    steamspy_data[['appid', 'name', 'owners_min', 'owners_max', 'price_usd']].head(10)
+    steamspy_data[get_tag_columns(steamspy_data)].sparse.density
+    steamspy_data.info(verbose=False, memory_usage="deep")
+
+    # cleaned store data from 2_Data_Cleaning.py, every store app gets its steamspy fields and tag votes
+    store_data = storage.read_table(export_path, 'initial_processing', fmt=export_format)
+    merged_data = merge_sorted(store_data, steamspy_data)
+    print(merged_data.shape)
+
+    merged_data[['steam_appid', 'name', 'owners_min', 'owners_max', 'positive', 'negative']].head(10)
+
+    export_data(steamspy_data, 'steamspy_clean', key='appid')
+    export_data(merged_data, 'merged_data', key='steam_appid')
+
+    # incremental refresh: after refresh_apps in the downloader only the changed apps are cleaned and merged again
+    #changed_apps = pd.read_csv(import_path + 'changed_apps.csv')
+    #steamspy_data = read_cleaned('steamspy_clean')
+    #merged_data = read_cleaned('merged_data')
+    #steamspy_updates = process_steamspy(raw_steamspy_data[raw_steamspy_data['appid'].isin(changed_apps['appid'])])
+    #steamspy_data = upsert_sorted(steamspy_data, steamspy_updates, 'appid')
+    #merged_data = refresh_merged(merged_data, store_data, steamspy_data, changed_apps['appid'])
+    #export_data(steamspy_data, 'steamspy_clean', key='appid')
+    #export_data(merged_data, 'merged_data', key='steam_appid')
+
+    # time, rows dropped and memory per step, collected only when STEAM_METRICS names a file (see metrics.py)
+    metrics.print_stages()
+
+#%%
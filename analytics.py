@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+This file is about to answer questions about the cleaned data from the sqlite database written by storage.py.
+
+Lookups go through the indexes made when the tables were written (appid, developer, publisher,
+release date and a full text index on name), only the matching rows are read into pandas.
+"""
+
+#%% standard library imports
+from contextlib import closing
+import os
+
+#%% third-party imports
+import pandas as pd
+
+#%% local imports
+import storage
+
+#%% settings
+steam_url = "https://store.steampowered.com/app/"
+
+# columns returned by find_apps when none are asked for, the ones missing from the table are skipped
+app_columns = ['steam_appid', 'name', 'developer', 'publisher', 'release_date', 'price']
+
+# multi value filters and the dimension tables holding their values, see normalize_dimensions in 2_Data_Cleaning.py
+dimension_filters = {'developer': 'developers', 'publisher': 'publishers', 'category': 'categories', 'genre': 'genres'}
+dimension_columns = {'developer': 'developer', 'publisher': 'publisher', 'category': 'categories', 'genre': 'genres'}
+
+#%% functions definition
+def connect(folder):
+    path = storage.get_table_path(folder, None, fmt='sqlite')
+
+    if not os.path.exists(path):
+        raise FileNotFoundError("No database in '{}', export the cleaned data with fmt='sqlite' first".format(folder))
+
+    return closing(storage.connect_database(path))
+
+def get_table_columns(con, table):
+    return [row[1] for row in con.execute('PRAGMA table_info({})'.format(storage.quote_name(table)))]
+
+def get_search_text(text):
+    # searched as a phrase prefix, so 'counter-str' finds 'Counter-Strike' and fts operators in text mean nothing
+    return '"{}"*'.format(text.replace('"', '""'))
+
+def get_dimension_condition(con, table_columns, field, value):
+    # with a dimension table the value is looked up once by index, apps come from the bridge table by id,
+    # so apps with many developers (or genres) are found by any of them
+    dimension = dimension_filters[field]
+    column = dimension_columns[field]
+
+    if storage.sqlite_table_exists(con, dimension) and storage.sqlite_table_exists(con, 'app_' + dimension):
+        return ('steam_appid IN (SELECT b.steam_appid FROM {} b JOIN {} d ON b.id = d.id WHERE d.value = ?)'.format(
+            storage.quote_name('app_' + dimension), storage.quote_name(dimension)), value)
+
+    if column not in table_columns:
+        raise ValueError("No '{}' column or '{}' table to filter by {}".format(column, dimension, field))
+
+    # values joined with ';' in one column, matched whole between separators
+    return "';' || {} || ';' LIKE ?".format(storage.quote_name(column)), '%;{};%'.format(value)
+
+def find_apps(folder, name=None, developer=None, publisher=None, category=None, genre=None, released_after=None,
+              released_before=None, appids=None, table='initial_processing', columns=None, limit=100):
+    conditions = []
+    parameters = []
+
+    with connect(folder) as con:
+        table_columns = get_table_columns(con, table)
+        selected = [column for column in (columns or app_columns) if column in table_columns]
+
+        if name is not None:
+            if storage.sqlite_table_exists(con, table + '_fts'):
+                conditions.append('rowid IN (SELECT rowid FROM {0} WHERE {0} MATCH ?)'.format(storage.quote_name(table + '_fts')))
+                parameters.append(get_search_text(name))
+            else:
+                conditions.append('name LIKE ?')
+                parameters.append('%{}%'.format(name))
+
+        for field, value in [('developer', developer), ('publisher', publisher), ('category', category), ('genre', genre)]:
+            if value is not None:
+                condition, parameter = get_dimension_condition(con, table_columns, field, value)
+                conditions.append(condition)
+                parameters.append(parameter)
+
+        # dates are stored as iso text, so comparing text compares dates
+        if released_after is not None:
+            conditions.append('release_date >= ?')
+            parameters.append(str(pd.Timestamp(released_after)))
+        if released_before is not None:
+            conditions.append('release_date < ?')
+            parameters.append(str(pd.Timestamp(released_before)))
+
+        if appids is not None:
+            appids = [int(appid) for appid in appids]
+            conditions.append('steam_appid IN ({})'.format(', '.join('?' * len(appids))))
+            parameters += appids
+
+        query = storage.get_select_query(table, selected)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY rowid'
+        if limit is not None:
+            query += ' LIMIT {:d}'.format(limit)
+
+        return pd.read_sql_query(query, con, params=parameters)
+
+def get_dimension_values(folder, field):
+    # every developer (or publisher, category, genre) with its number of apps, most apps first
+    dimension = dimension_filters[field]
+
+    with connect(folder) as con:
+        return pd.read_sql_query('SELECT d.value, count(b.steam_appid) AS apps FROM {} d JOIN {} b ON b.id = d.id '
+                                 'GROUP BY d.id ORDER BY apps DESC, d.value'.format(
+                                     storage.quote_name(dimension), storage.quote_name('app_' + dimension)), con)
+
+def get_all_columns(folder, table):
+    with connect(folder) as con:
+        return get_table_columns(con, table)
+
+def get_side_data(folder, table, appids, columns=None):
+    # side table rows of some apps only, e.g. get_side_data(export_path, 'requirements_data', [10, 730])
+    return find_apps(folder, appids=appids, table=table, columns=columns or get_all_columns(folder, table), limit=None)
+
+def print_steam_links(folder, limit=100, **filters):
+    # same output as print_steam_links in 2_Data_Cleaning.py, without loading the cleaned data
+    apps = find_apps(folder, columns=['steam_appid', 'name'], limit=limit, **filters)
+
+    for appid, name in zip(apps['steam_appid'], apps['name']):
+        print(name + ':', steam_url + str(appid))
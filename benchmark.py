@@ -0,0 +1,641 @@
+# -*- coding: utf-8 -*-
+"""
+This file is about to benchmark the downloading and cleaning scripts on synthetic data.
+
+Steam and Steamspy data files of any size are generated in the shape the downloader writes them,
+every cleaning step and the whole cleaning run are timed on them, Steamspy data is cleaned and merged with
+the store data, and the downloader is timed against a local stub server. Results are appended to a json history file and compared with the previous run.
+"""
+
+#%% standard library imports
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import csv
+import datetime as dt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#%% third-party imports
+import numpy as np
+import pandas as pd
+
+#%% settings
+repo_path = os.path.dirname(os.path.abspath(__file__))
+downloader_script = os.path.join(repo_path, '1_Steamspy_Downloading_Data.py')
+cleaning_script = os.path.join(repo_path, '2_Data_Cleaning.py')
+steamspy_cleaning_script = os.path.join(repo_path, '3_Steamspy_Data_Cleaning.py')
+
+# generated data files are reused between runs, history keeps one entry per run
+benchmark_path = os.path.join(repo_path, 'benchmark_files')
+history_filename = 'benchmark_history.json'
+
+# a run is reported as a regression when a case gets slower than this against the previous run
+regression_threshold = 0.10
+
+#%% synthetic data
+words = ['Dark', 'Space', 'Legend', 'Quest', 'Tower', 'Pixel', 'Shadow', 'Empire', 'Farm', 'Rogue',
+         'Knight', 'Galaxy', 'Zombie', 'Racing', 'Puzzle', 'Dungeon', 'Island', 'City', 'War', 'Story']
+studio_words = ['Games', 'Studio', 'Interactive', 'Entertainment', 'Software', 'Labs', 'Digital']
+
+categories = {2: 'Single-player', 1: 'Multi-player', 22: 'Steam Achievements', 28: 'Full controller support',
+              29: 'Steam Trading Cards', 23: 'Steam Cloud', 36: 'Online PvP', 9: 'Co-op'}
+genres = {'1': 'Action', '23': 'Indie', '25': 'Adventure', '4': 'Casual', '28': 'Simulation',
+          '2': 'Strategy', '3': 'RPG', '37': 'Free to Play'}
+tags = ['Indie', 'Action', 'Casual', 'Adventure', 'Singleplayer', 'Simulation', 'Strategy', 'RPG',
+        'Puzzle', 'Pixel Graphics', '2D', 'Multiplayer', 'Atmospheric', 'Story Rich', 'Early Access']
+languages = ['English', 'German', 'French', 'Spanish - Spain', 'Polish', 'Russian', 'Japanese',
+             'Simplified Chinese', 'Italian', 'Portuguese - Brazil']
+owners = ['0 .. 20,000', '20,000 .. 50,000', '50,000 .. 100,000', '100,000 .. 200,000',
+          '200,000 .. 500,000', '500,000 .. 1,000,000', '1,000,000 .. 2,000,000', '2,000,000 .. 5,000,000']
+owners_weights = [60, 15, 9, 6, 5, 3, 1.5, 0.5]
+month_names = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+def get_appids(rows):
+    # store appids are multiples of 10, like most of the real ones
+    return range(10, 10 * rows + 10, 10)
+
+def make_app_names(appid):
+    # names and studios depend on appid only, so steam, steamspy and the stub server agree on them
+    rng = random.Random('app-{}'.format(appid))
+    name = '{} {} {}'.format(rng.choice(words), rng.choice(words), appid)
+    developer = '{} {}'.format(rng.choice(words), rng.choice(studio_words))
+    publisher = developer if rng.random() < 0.6 else '{} {}'.format(rng.choice(words), rng.choice(studio_words))
+
+    return name, developer, publisher
+
+def make_requirements(rng, heading, system):
+    storage_size = rng.choice(['500 MB', '2 GB', '20 GB', '60 GB'])
+
+    return ('<strong>{}:</strong><br><ul class="bb_ul"><li><strong>OS:</strong> {}<br></li>'
+            '<li><strong>Processor:</strong> {} GHz<br></li><li><strong>Memory:</strong> {} GB RAM<br></li>'
+            '<li><strong>Graphics:</strong> {} MB VRAM<br></li><li><strong>DirectX:</strong> Version {}<br></li>'
+            '<li><strong>Storage:</strong> {} available space</li></ul>').format(
+                heading, system, rng.choice(['1.8', '2.4', '3.0']), rng.choice([2, 4, 8, 16]),
+                rng.choice([256, 1024, 4096]), rng.choice([9, 10, 11, 12]), storage_size)
+
+def make_release_date(rng):
+    year = rng.randint(1998, 2024)
+    month = rng.choice(month_names)
+    day = rng.randint(1, 28)
+    kind = rng.random()
+
+    if kind < 0.03:
+        return {'coming_soon': True, 'date': rng.choice(['Coming soon', 'To be announced', 'Q{} {}'.format(rng.randint(1, 4), year + 1)])}
+    if kind < 0.04:
+        return {'coming_soon': False, 'date': ''}
+    if kind < 0.80:
+        date = '{} {}, {}'.format(day, month, year)
+    elif kind < 0.95:
+        date = '{} {}, {}'.format(month, day, year)
+    elif kind < 0.98:
+        date = '{} {}'.format(month, year)
+    elif kind < 0.99:
+        date = str(year)
+    else:
+        # store pages in other languages
+        date = rng.choice(['{d} nov. {y}', '{y}年{m}月{d}日', 'Sept {d}, {y}', '{d}. Nov. {y}', '{d} de nov. de {y}',
+                           '{d} нояб. {y}']).format(d=day, m=rng.randint(1, 12), y=year)
+
+    return {'coming_soon': False, 'date': date}
+
+def make_steam_app(appid):
+    # one appdetails 'data' object, None for apps the store api has no data for
+    rng = random.Random(appid)
+    name, developer, publisher = make_app_names(appid)
+
+    if rng.random() < 0.05:
+        return None
+
+    app_type = 'dlc' if rng.random() < 0.1 else 'game'
+    is_free = rng.random() < 0.1
+    text = ' '.join(rng.choice(words).lower() for i in range(40))
+
+    app = {
+        'type': app_type, 'name': name, 'steam_appid': appid,
+        'required_age': rng.choice([0] * 20 + [12, 16, 18, '18+']),
+        'is_free': is_free,
+        'controller_support': 'full' if rng.random() < 0.3 else None,
+        'dlc': [appid + 10 * i for i in range(1, 4)] if rng.random() < 0.2 else None,
+        'detailed_description': '<h2>{}</h2><p>{}</p><img src="https://cdn.example.com/{}/extra.gif">'.format(name, text, appid),
+        'about_the_game': '<p>{}</p>'.format(text),
+        'short_description': text[:120],
+        'fullgame': {'appid': str(appid - 10), 'name': name} if app_type == 'dlc' else None,
+        'supported_languages': ', '.join(['English<strong>*</strong>'] * (rng.random() < 0.95) + rng.sample(languages[1:], rng.randint(0, 4)))
+                               + '<br><strong>*</strong>languages with full audio support',
+        'header_image': 'https://cdn.example.com/steam/apps/{}/header.jpg?t=1695000000'.format(appid),
+        'website': 'https://www.example.com/{}'.format(appid) if rng.random() < 0.6 else None,
+        'pc_requirements': {'minimum': make_requirements(rng, 'Minimum', 'Windows 10'),
+                            'recommended': make_requirements(rng, 'Recommended', 'Windows 11')},
+        'mac_requirements': {'minimum': make_requirements(rng, 'Minimum', 'macOS 11')} if rng.random() < 0.2 else [],
+        'linux_requirements': {'minimum': make_requirements(rng, 'Minimum', 'Ubuntu 20.04')} if rng.random() < 0.15 else [],
+        'legal_notice': '(c) {} {}'.format(rng.randint(2000, 2024), developer) if rng.random() < 0.2 else None,
+        'drm_notice': None,
+        'ext_user_account_notice': 'Account required' if rng.random() < 0.05 else None,
+        'developers': [developer] + ['{} Port'.format(developer)] * (rng.random() < 0.03) if rng.random() < 0.98 else None,
+        'publishers': [''] if rng.random() < 0.02 else [publisher],
+        'demos': [{'appid': appid + 1, 'description': ''}] if rng.random() < 0.05 else None,
+        'packages': [appid * 10 + 1],
+        'package_groups': [],
+        'platforms': {'windows': True, 'mac': rng.random() < 0.2, 'linux': rng.random() < 0.15},
+        'metacritic': {'score': rng.randint(40, 95), 'url': 'https://www.metacritic.com/game/{}'.format(appid)} if rng.random() < 0.1 else None,
+        'reviews': None,
+        'categories': [{'id': key, 'description': categories[key]} for key in rng.sample(list(categories), rng.randint(1, 4))] if rng.random() < 0.97 else None,
+        'genres': [{'id': key, 'description': genres[key]} for key in rng.sample(list(genres), rng.randint(1, 3))] if rng.random() < 0.97 else None,
+        'screenshots': [{'id': i, 'path_thumbnail': 'https://cdn.example.com/{}/ss_{}.600x338.jpg'.format(appid, i),
+                         'path_full': 'https://cdn.example.com/{}/ss_{}.1920x1080.jpg'.format(appid, i)} for i in range(rng.randint(1, 5))],
+        'movies': [{'id': appid * 100, 'name': 'Trailer', 'thumbnail': 'https://cdn.example.com/{}/movie.jpg'.format(appid),
+                    'highlight': True}] if rng.random() < 0.7 else None,
+        'recommendations': {'total': rng.randint(1, 50000)} if rng.random() < 0.6 else None,
+        'achievements': {'total': rng.randint(1, 100), 'highlighted': []} if rng.random() < 0.6 else None,
+        'release_date': make_release_date(rng),
+        'support_info': {'url': 'https://support.example.com/{}'.format(appid) if rng.random() < 0.5 else '',
+                         'email': 'support@example.com' if rng.random() < 0.7 else ''},
+        'background': 'https://cdn.example.com/steam/apps/{}/page_bg_generated_v6b.jpg'.format(appid),
+        'content_descriptors': {'ids': [], 'notes': None},
+        }
+
+    if not is_free:
+        if rng.random() < 0.05:
+            app['price_overview'] = None
+        else:
+            currency = rng.choice(['PLN'] * 16 + ['EUR', 'EUR', 'USD', 'GBP'])
+            initial = rng.choice([399, 999, 1999, 3699, 5999, 24999])
+            discount = rng.choice([0, 0, 0, 10, 50])
+            final = initial * (100 - discount) // 100
+            app['price_overview'] = {'currency': currency, 'initial': initial, 'final': final, 'discount_percent': discount,
+                                     'initial_formatted': '', 'final_formatted': '{:.2f} {}'.format(final / 100, currency)}
+
+    return app
+
+def make_steam_row(appid):
+    # failed requests are written by the downloader with name and appid only
+    app = make_steam_app(appid)
+
+    if app is None:
+        return {'name': make_app_names(appid)[0], 'steam_appid': appid}
+
+    return app
+
+def make_steamspy_app(appid):
+    rng = random.Random('steamspy-{}'.format(appid))
+    name, developer, publisher = make_app_names(appid)
+    price = rng.choice([0, 399, 999, 1999, 3699])
+    positive = rng.randint(0, 20000)
+
+    return {
+        'appid': appid, 'name': name, 'developer': developer, 'publisher': publisher,
+        'score_rank': '', 'positive': positive, 'negative': rng.randint(0, positive // 4 + 1), 'userscore': 0,
+        'owners': rng.choices(owners, weights=owners_weights)[0],
+        'average_forever': rng.randint(0, 3000), 'average_2weeks': rng.randint(0, 300),
+        'median_forever': rng.randint(0, 3000), 'median_2weeks': rng.randint(0, 300),
+        'price': str(price), 'initialprice': str(price), 'discount': '0',
+        'languages': ', '.join(['English'] + rng.sample(languages[1:], rng.randint(0, 5))),
+        'genre': ', '.join(rng.sample(list(genres.values()), rng.randint(1, 3))),
+        'ccu': rng.randint(0, 500),
+        'tags': {tag: rng.randint(10, 5000) for tag in rng.sample(tags, rng.randint(0, 10))},
+        }
+
+def encode_row(row, encoding):
+    # 'repr' is the python repr the first downloads were written with, 'json' what the downloader writes now
+    encode = repr if encoding == 'repr' else json.dumps
+
+    return {key: encode(value) if isinstance(value, (dict, list)) else value for key, value in row.items()}
+
+def write_synthetic_data(path, make_row, columns, rows, encoding='repr', duplicate_every=100):
+    tmp_path = path + '.tmp'
+
+    # written row by row like the downloader does, so a million apps never sit in memory at once
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+
+        for i, appid in enumerate(get_appids(rows)):
+            row = encode_row(make_row(appid), encoding)
+            writer.writerow(row)
+
+            # real downloads hold some apps twice
+            if duplicate_every and i % duplicate_every == duplicate_every - 1:
+                writer.writerow(row)
+
+    os.replace(tmp_path, path)
+
+    return path
+
+def get_synthetic_data(name, rows, encoding='repr'):
+    downloader = load_script(downloader_script, 'steam_downloader')
+    make_row, columns = {'steam_app_data': (make_steam_row, downloader.steam_columns),
+                         'steamspy_data': (make_steamspy_app, downloader.steamspy_columns)}[name]
+
+    data_path = os.path.join(benchmark_path, 'data')
+    os.makedirs(data_path, exist_ok=True)
+    path = os.path.join(data_path, '{}_{}_{}.csv'.format(name, rows, encoding))
+
+    if not os.path.exists(path):
+        print("Generating {} rows of {} ({})...".format(rows, name, encoding))
+        write_synthetic_data(path, make_row, columns, rows, encoding)
+
+    return path
+
+def make_app_list(apps):
+    return pd.DataFrame([{'appid': appid, 'name': make_app_names(appid)[0]} for appid in get_appids(apps)])
+
+#%% stub api server
+class StubApiHandler(BaseHTTPRequestHandler):
+    # keep-alive, so the downloader's pooled connections are reused the way they are against the real apis
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = dict(parse_qsl(url.query))
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        with self.server.lock:
+            throttled = self.server.rng.random() < self.server.error_rate
+
+        if throttled:
+            self.send_json(429, None, {'Retry-After': '0'})
+        elif url.path == '/api/appdetails/' and 'appids' in query:
+            appid = int(query['appids'])
+            app = make_steam_app(appid)
+            self.send_json(200, {str(appid): {'success': False} if app is None else {'success': True, 'data': app}})
+        elif url.path == '/api.php' and query.get('request') == 'appdetails':
+            self.send_json(200, make_steamspy_app(int(query['appid'])))
+        else:
+            self.send_json(404, None)
+
+    def send_json(self, status, body, headers=None):
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_server(latency=0, error_rate=0, seed=0):
+    # latency is added to every response, error_rate is the share of requests answered with 429
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubApiHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.error_rate = error_rate
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+#%% measuring
+def load_script(path, name):
+    # numbered scripts can't be imported by name, they are loaded from their files instead
+    if name in sys.modules:
+        return sys.modules[name]
+
+    if repo_path not in sys.path:
+        sys.path.insert(0, repo_path)
+
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+
+    # a script failing on import is not left half loaded for the next caller
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+
+    return module
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+def get_rss_mb():
+    # current resident memory, only linux exposes it without extra packages
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+@contextlib.contextmanager
+def sample_rss(interval=0.005):
+    # ru_maxrss only grows during a process, steps sharing one process get their own peak by sampling rss
+    samples = [get_rss_mb()]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            samples.append(get_rss_mb())
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+
+    try:
+        yield samples
+    finally:
+        done.set()
+        thread.join()
+        samples.append(get_rss_mb())
+
+def measure(step, function, *args):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+
+    # progress prints of the scripts would drown the benchmark output
+    with contextlib.redirect_stdout(io.StringIO()), sample_rss() as samples:
+        value = function(*args)
+
+    result = {'step': step, 'wall_s': time.perf_counter() - wall, 'cpu_s': time.process_time() - cpu}
+
+    # without /proc the process high water mark is all there is
+    if samples[0] is None:
+        result.update(peak_rss_mb=get_peak_rss_mb(), rss_delta_mb=None)
+    else:
+        result.update(peak_rss_mb=max(samples), rss_delta_mb=samples[-1] - samples[0])
+
+    return value, result
+
+def measure_step(step, function, df):
+    result_df, result = measure(step, function, df)
+    result.update(rows_in=len(df), rows_out=len(result_df))
+
+    return result_df, result
+
+def run_isolated(function, *args):
+    # every case runs in a fresh process, so peak rss and module state are not carried over between cases
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+#%% cleaning benchmark
+def get_cleaning_steps(cleaning, engine, export):
+    # same order as process and process_vectorized, each step gets the output of the one before
+    if engine == 'process':
+        row_steps = [
+            ('process_name_type', cleaning.process_name_type),
+            ('process_age', cleaning.process_age),
+            ('process_platforms', cleaning.process_platforms),
+            ('process_price', cleaning.process_price),
+            ('process_language', cleaning.process_language),
+            ('process_dev_and_pub', cleaning.process_dev_and_pub),
+            ('process_cat_and_gen', cleaning.process_cat_and_gen),
+            ('process_achiev_recom_and_desc', cleaning.process_achiev_recom_and_desc),
+            ('process_descriptions', lambda df: cleaning.process_descriptions(df, export=export)),
+            ('process_media', lambda df: cleaning.process_media(df, export=export)),
+            ('process_info', lambda df: cleaning.process_info(df, export=export)),
+            ('process_requirements', lambda df: cleaning.process_requirements(df, export=export)),
+            ('process_data_release', cleaning.process_data_release),
+            ]
+    else:
+        row_steps = [
+            ('process_name_type', cleaning.process_name_type),
+            ('process_age', cleaning.process_age),
+            ('process_platforms_vectorized', cleaning.process_platforms_vectorized),
+            ('process_price_vectorized', cleaning.process_price_vectorized),
+            ('process_language_vectorized', cleaning.process_language_vectorized),
+            ('process_dev_and_pub', cleaning.process_dev_and_pub),
+            ('process_cat_and_gen_vectorized', cleaning.process_cat_and_gen_vectorized),
+            ('process_achiev_recom_and_desc_vectorized', cleaning.process_achiev_recom_and_desc_vectorized),
+            ('process_descriptions', lambda df: cleaning.process_descriptions(df, export=export)),
+            ('process_media', lambda df: cleaning.process_media(df, export=export)),
+            ('process_info_vectorized', lambda df: cleaning.process_info_vectorized(df, export=export)),
+            ('process_requirements_vectorized', lambda df: cleaning.process_requirements_vectorized(df, export=export)),
+            ('process_data_release_vectorized', cleaning.process_data_release_vectorized),
+            ]
+
+    return [('drop_duplicates', lambda df: df.copy().drop_duplicates()),
+            ('drop_null_cols', cleaning.drop_null_cols)] + row_steps
+
+def run_cleaning_case(data_file, engine, rows, by_step, export):
+    cleaning = load_script(cleaning_script, 'steam_cleaning')
+    results = []
+
+    with tempfile.TemporaryDirectory() as export_path:
+        # side tables of a benchmark run are written next to nothing that matters and removed afterwards
+        cleaning.export_path = export_path
+
+        raw_data, result = measure('read_csv', pd.read_csv, data_file)
+        result.update(rows_in=None, rows_out=len(raw_data))
+        results.append(result)
+
+        if by_step:
+            df = raw_data
+            for step, function in get_cleaning_steps(cleaning, engine, export):
+                df, result = measure_step(step, function, df)
+                results.append(result)
+        else:
+            df, result = measure_step('total', lambda df: getattr(cleaning, engine)(df, export=export), raw_data)
+            results.append(result)
+
+    # mode tells the read_csv of a step by step run from the one of a total run
+    mode = 'steps' if by_step else 'total'
+
+    return [dict(result, benchmark='clean', engine=engine, rows=rows, mode=mode) for result in results]
+
+def benchmark_cleaning(sizes, engines, encoding='repr', export=True):
+    results = []
+
+    for rows in sizes:
+        data_file = get_synthetic_data('steam_app_data', rows, encoding)
+
+        for engine in engines:
+            for by_step in [True, False]:
+                print("Cleaning {} rows with {} ({})...".format(rows, engine, 'steps' if by_step else 'total'))
+                results += run_isolated(run_cleaning_case, data_file, engine, rows, by_step, export)
+
+    return results
+
+#%% steamspy cleaning benchmark
+def run_steamspy_case(steamspy_file, store_file, rows):
+    cleaning = load_script(cleaning_script, 'steam_cleaning')
+    steamspy_cleaning = load_script(steamspy_cleaning_script, 'steamspy_cleaning')
+    results = []
+
+    raw_data, result = measure('read_csv', pd.read_csv, steamspy_file)
+    result.update(rows_in=None, rows_out=len(raw_data))
+    results.append(result)
+
+    steamspy_data, result = measure_step('process_steamspy', steamspy_cleaning.process_steamspy, raw_data)
+    results.append(result)
+
+    # store data is cleaned untimed, only the merge with it is measured
+    with contextlib.redirect_stdout(io.StringIO()):
+        store_data = cleaning.process_vectorized(pd.read_csv(store_file), export=False)
+
+    merged_data, result = measure('merge_sorted', steamspy_cleaning.merge_sorted, store_data, steamspy_data)
+    result.update(rows_in=len(store_data), rows_out=len(merged_data))
+    results.append(result)
+
+    return [dict(result, benchmark='steamspy', rows=rows) for result in results]
+
+def benchmark_steamspy(sizes, encoding='repr'):
+    results = []
+
+    for rows in sizes:
+        steamspy_file = get_synthetic_data('steamspy_data', rows, encoding)
+        store_file = get_synthetic_data('steam_app_data', rows, encoding)
+
+        print("Cleaning and merging {} steamspy rows...".format(rows))
+        results += run_isolated(run_steamspy_case, steamspy_file, store_file, rows)
+
+    return results
+
+#%% downloader benchmark
+def run_download_case(api, apps, concurrency, batchsize, latency, error_rate):
+    downloader = load_script(downloader_script, 'steam_downloader')
+    server = start_stub_server(latency, error_rate)
+
+    try:
+        host, port = server.server_address
+        downloader.STEAM_URL = 'http://{}:{}/api/appdetails/'.format(host, port)
+        downloader.STEAMSPY_URL = 'http://{}:{}/api.php'.format(host, port)
+
+        if api == 'steam':
+            parser, columns, data_filename = downloader.parse_steam_request, downloader.steam_columns, 'steam_app_data.csv'
+        else:
+            parser, columns, data_filename = downloader.parse_steamspy_request, downloader.steamspy_columns, 'steamspy_data.csv'
+
+        app_list = make_app_list(apps)
+
+        with tempfile.TemporaryDirectory() as download_path:
+            downloader.prepare_data_file(download_path, data_filename, 0, columns)
+
+            # serial mode (concurrency None) runs without the pause, only the code and the stub are timed
+            value, result = measure('process_batches', downloader.process_batches,
+                                    parser, app_list, download_path, data_filename, 'journal.jsonl', columns,
+                                    0, -1, batchsize, 0, concurrency)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # one endpoint per case, summed anyway so a case touching more of them still reports everything
+    stats = {field: sum(endpoint[field] for endpoint in downloader.request_stats.values())
+             for field in ['requests', 'retries', 'status_429', 'failures']}
+    latency_values = [value for endpoint in downloader.request_stats.values() for value in endpoint['latency']] or [np.nan]
+
+    result.update(benchmark='download', api=api, apps=apps, concurrency=concurrency,
+                  apps_per_s=apps / result['wall_s'], requests=stats['requests'], retries=stats['retries'],
+                  status_429=stats['status_429'], failures=stats['failures'],
+                  latency_p50_s=float(np.percentile(latency_values, 50)), latency_p95_s=float(np.percentile(latency_values, 95)))
+
+    return [result]
+
+def benchmark_download(apis, apps, concurrencies, batchsize=100, latency=0.01, error_rate=0.01):
+    results = []
+
+    for api in apis:
+        for concurrency in concurrencies:
+            print("Downloading {} {} apps from stub server (concurrency {})...".format(apps, api, concurrency))
+            results += run_isolated(run_download_case, api, apps, concurrency, batchsize, latency, error_rate)
+
+    return results
+
+#%% history
+key_fields = ['benchmark', 'engine', 'api', 'rows', 'apps', 'concurrency', 'mode', 'step']
+
+def get_case_key(result):
+    return '/'.join(str(result[field]) for field in key_fields if field in result)
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_path,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def read_history(history_path):
+    if not os.path.exists(history_path):
+        return []
+
+    with open(history_path, encoding='utf-8') as f:
+        return json.load(f)
+
+def append_history(history_path, results):
+    history = read_history(history_path)
+    history.append({'timestamp': dt.datetime.now().isoformat(timespec='seconds'), 'commit': get_commit(),
+                    'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+                    'cpus': os.cpu_count(), 'results': results})
+
+    # written aside and swapped in, an interrupted run never leaves a broken history behind
+    tmp_path = history_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(history, f, indent=1)
+    os.replace(tmp_path, history_path)
+
+    return history
+
+def print_comparison(history, threshold=regression_threshold):
+    current = history[-1]
+    previous = {get_case_key(result): result for result in history[-2]['results']} if len(history) > 1 else {}
+    regressions = 0
+
+    for result in current['results']:
+        key = get_case_key(result)
+        line = "{:<75} {:>9.3f}s  peak {:>8.1f} MB".format(key, result['wall_s'], result['peak_rss_mb'] or 0)
+
+        if key in previous and previous[key]['wall_s'] > 0:
+            change = result['wall_s'] / previous[key]['wall_s'] - 1
+            line += "  {:+.1%}".format(change)
+            if change > threshold:
+                line += "  SLOWER"
+                regressions += 1
+
+        print(line)
+
+    if previous:
+        print("\n{} cases slower than commit {} by more than {:.0%}".format(regressions, history[-2]['commit'], threshold))
+
+#%% benchmarks
+if __name__ == '__main__':
+
+    # 1M rows takes long with the reference process (every nested cell is parsed), drop it from sizes for a quick check
+    sizes = [10000, 100000, 1000000]
+    engines = ['process', 'process_vectorized']
+
+    # synthetic files use python repr for nested fields like the first downloads, 'json' is what the downloader writes now
+    encoding = 'repr'
+
+    os.makedirs(benchmark_path, exist_ok=True)
+
+    results = benchmark_cleaning(sizes, engines, encoding)
+
+    # steamspy cleaning and the sorted merge with the cleaned store data of the same size
+    results += benchmark_steamspy(sizes, encoding)
+
+    # stub server answers with a fixed latency and throttles a share of requests with 429 to exercise retries
+    results += benchmark_download(['steam', 'steamspy'], apps=2000, concurrencies=[None, 4, 16], latency=0.01, error_rate=0.01)
+
+    history = append_history(os.path.join(benchmark_path, history_filename), results)
+    print_comparison(history)
+
+#%%
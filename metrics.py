@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+This file is about to measure the downloading and cleaning scripts while they run.
+
+Metrics are off until STEAM_METRICS names a json file, then every stage (see stage and timer) is timed
+and written there when the script exits. STEAM_PROFILE=cprofile or STEAM_PROFILE=pyinstrument profiles
+the whole run as well, the profile is written next to the metrics file.
+"""
+
+#%% standard library imports
+import atexit
+import bisect
+import contextlib
+import cProfile
+import datetime as dt
+import functools
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#%% third-party imports
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+#%% settings
+metrics_path = os.environ.get('STEAM_METRICS') or None
+profiler_name = os.environ.get('STEAM_PROFILE') or None
+profilers = ['cprofile', 'pyinstrument']
+
+# worker processes inherit the pid of the process that started the run, they write to their own files
+main_pid = int(os.environ.setdefault('STEAM_METRICS_PID', str(os.getpid())))
+
+# upper bounds (seconds) of the latency histogram buckets, the last bucket holds everything slower
+latency_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+stages = {}
+stages_lock = threading.Lock()
+
+# functions called when metrics are written, each one adds a section to the file (see register_report)
+reports = {}
+
+profiler = None
+started = dt.datetime.now().isoformat(timespec='seconds')
+
+#%% functions definition
+def get_rss_mb():
+    # current resident memory, only linux exposes it without extra packages
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+def get_rows(value):
+    # frames and series have a row count, anything else (json responses, None) does not
+    shape = getattr(value, 'shape', None)
+
+    return shape[0] if shape else None
+
+def record_stage(name, wall, cpu, rows_in=None, rows_out=None, memory_delta=None):
+    with stages_lock:
+        record = stages.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'max_wall_s': 0.0, 'cpu_s': 0.0,
+                                          'rows_in': 0, 'rows_out': 0, 'rows_dropped': 0,
+                                          'memory_delta_mb': 0.0, 'peak_rss_mb': None})
+        record['calls'] += 1
+        record['wall_s'] += wall
+        record['max_wall_s'] = max(record['max_wall_s'], wall)
+        record['cpu_s'] += cpu
+
+        if rows_in is not None and rows_out is not None:
+            record['rows_in'] += rows_in
+            record['rows_out'] += rows_out
+            record['rows_dropped'] += rows_in - rows_out
+
+        if memory_delta is not None:
+            record['memory_delta_mb'] += memory_delta
+
+        record['peak_rss_mb'] = get_peak_rss_mb()
+
+@contextlib.contextmanager
+def timer(name, rows_in=None):
+    # set 'rows_out' on the yielded dict to count rows dropped by the block
+    record = {'rows_in': rows_in, 'rows_out': None}
+
+    if metrics_path is None:
+        yield record
+        return
+
+    rss = get_rss_mb()
+    wall = time.perf_counter()
+    # cpu time of this thread only, downloads run many requests side by side
+    cpu = time.thread_time()
+
+    yield record
+
+    rss_after = get_rss_mb()
+    memory_delta = rss_after - rss if rss is not None and rss_after is not None else None
+    record_stage(name, time.perf_counter() - wall, time.thread_time() - cpu,
+                 record['rows_in'], record['rows_out'], memory_delta)
+
+def stage(name=None):
+    # decorator for steps taking a frame first and returning one, rows in and out are taken from them
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if metrics_path is None:
+                return function(*args, **kwargs)
+
+            with timer(stage_name, rows_in=get_rows(args[0]) if args else None) as record:
+                result = function(*args, **kwargs)
+                record['rows_out'] = get_rows(result)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+def histogram(values, buckets=latency_buckets):
+    counts = [0] * (len(buckets) + 1)
+
+    for value in values:
+        counts[bisect.bisect_left(buckets, value)] += 1
+
+    labels = ['<={}'.format(bucket) for bucket in buckets] + ['>{}'.format(buckets[-1])]
+
+    return dict(zip(labels, counts))
+
+def summarize(values):
+    if not values:
+        return None
+
+    ordered = sorted(values)
+
+    return {'mean': statistics.mean(ordered), 'p50': ordered[len(ordered) // 2],
+            'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 'max': ordered[-1]}
+
+def register_report(name, function):
+    reports[name] = function
+
+def get_metrics_path():
+    if os.getpid() == main_pid:
+        return metrics_path
+
+    base, ext = os.path.splitext(metrics_path)
+
+    return '{}.{}{}'.format(base, os.getpid(), ext)
+
+def make_folder(path):
+    folder = os.path.dirname(path)
+
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+def write_metrics(path=None):
+    path = path or get_metrics_path()
+
+    with stages_lock:
+        stage_records = {name: dict(record) for name, record in stages.items()}
+
+    data = {'script': os.path.basename(sys.argv[0]), 'pid': os.getpid(), 'started': started,
+            'finished': dt.datetime.now().isoformat(timespec='seconds'), 'peak_rss_mb': get_peak_rss_mb(),
+            'stages': stage_records, 'reports': {name: function() for name, function in reports.items()}}
+
+    make_folder(path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_path, path)
+
+    return path
+
+def print_stages():
+    # slowest stages first
+    with stages_lock:
+        records = sorted(stages.items(), key=lambda item: item[1]['wall_s'], reverse=True)
+
+    for name, record in records:
+        print("{:<45} {:>7} calls {:>10.3f}s wall {:>10.3f}s cpu {:>9} rows dropped {:>+9.1f} MB".format(
+            name, record['calls'], record['wall_s'], record['cpu_s'], record['rows_dropped'], record['memory_delta_mb']))
+
+#%% profiling
+def start_profiler(name):
+    global profiler
+
+    if name not in profilers:
+        raise ValueError("Unknown profiler '{}', use one of {}".format(name, profilers))
+
+    if name == 'pyinstrument' and pyinstrument is None:
+        raise ImportError("Profiling with pyinstrument needs it installed, install it or use STEAM_PROFILE=cprofile")
+
+    # both profilers only follow the thread they were started in, background downloads show up as waits
+    if name == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+
+def stop_profiler():
+    global profiler
+
+    if profiler is None:
+        return None
+
+    base = os.path.splitext(get_metrics_path())[0]
+    make_folder(base)
+
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        path = base + '.prof'
+        profiler.dump_stats(path)
+    else:
+        profiler.stop()
+        path = base + '.html'
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(profiler.output_html())
+
+    profiler = None
+
+    return path
+
+def finish():
+    stop_profiler()
+    write_metrics()
+
+if metrics_path is not None:
+    if profiler_name is not None:
+        start_profiler(profiler_name)
+
+    atexit.register(finish)
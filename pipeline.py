@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+This file is about to run cleaning steps as a graph of stages with their results cached on disk.
+
+Every stage result is stored under a key made of the keys of the stages it depends on, the source code
+of its functions, its parameters and settings and the content of the files it reads. A stage is only
+run again when one of those changed, everything else is read back from the cache or not touched at all.
+"""
+
+#%% standard library imports
+import graphlib
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import time
+
+#%% settings
+# cached results kept per stage, older ones are removed when a new result is written
+keep_versions = 3
+
+file_hashes_filename = 'file_hashes.json'
+
+#%% functions definition
+def make_stage(name, function, deps=(), params=None, code=(), settings=None, files=(), copy_inputs=True):
+    # function gets the results of deps in order plus params, code lists helpers it calls (their source is
+    # part of the key), settings are module values it reads and files are paths whose content it depends on
+    # copy_inputs=False is for stages that never change their inputs, like column selections
+    return {'name': name, 'function': function, 'deps': list(deps), 'params': dict(params or {}),
+            'code': [function] + list(code), 'settings': dict(settings or {}), 'files': list(files),
+            'copy_inputs': copy_inputs}
+
+def get_code_hash(function):
+    try:
+        source = inspect.getsource(function)
+    except (OSError, TypeError):
+        # builtins and functions defined in a console have no source, their name has to do
+        source = getattr(function, '__qualname__', repr(function))
+
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+def iter_files(path):
+    # parquet tables are directories, every file in them counts
+    if os.path.isdir(path):
+        for root, dirs, files in sorted(os.walk(path)):
+            dirs.sort()
+            for filename in sorted(files):
+                yield os.path.join(root, filename)
+    else:
+        yield path
+
+def hash_file(path, chunksize=1024**2):
+    sha = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+def get_file_hash(cache_path, path, file_hashes):
+    # content hashes are remembered by size and mtime, a big raw file is only read again when it changed
+    sha = hashlib.sha256()
+
+    for file_path in iter_files(path):
+        info = os.stat(file_path)
+        fingerprint = [info.st_size, info.st_mtime_ns]
+        known = file_hashes.get(file_path)
+
+        if known is None or known['fingerprint'] != fingerprint:
+            known = {'fingerprint': fingerprint, 'sha256': hash_file(file_path)}
+            file_hashes[file_path] = known
+
+        sha.update(os.path.relpath(file_path, path).encode('utf-8'))
+        sha.update(known['sha256'].encode('utf-8'))
+
+    return sha.hexdigest()
+
+def read_file_hashes(cache_path):
+    path = os.path.join(cache_path, file_hashes_filename)
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def write_file_hashes(cache_path, file_hashes):
+    path = os.path.join(cache_path, file_hashes_filename)
+
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(file_hashes, f)
+    os.replace(path + '.tmp', path)
+
+def get_needed_stages(stages_by_name, targets):
+    needed = set()
+    pending = list(targets)
+
+    while pending:
+        name = pending.pop()
+        if name not in stages_by_name:
+            raise KeyError("Unknown stage '{}'".format(name))
+
+        if name not in needed:
+            needed.add(name)
+            pending += stages_by_name[name]['deps']
+
+    return needed
+
+def get_stage_keys(stages_by_name, needed, cache_path):
+    graph = {name: stages_by_name[name]['deps'] for name in needed}
+    file_hashes = read_file_hashes(cache_path)
+    keys = {}
+
+    # dependencies first, a stage key is built from the keys of the stages it reads
+    for name in graphlib.TopologicalSorter(graph).static_order():
+        stage = stages_by_name[name]
+        parts = {'name': name,
+                 'deps': [keys[dep] for dep in stage['deps']],
+                 'code': [get_code_hash(function) for function in stage['code']],
+                 'params': stage['params'],
+                 'settings': stage['settings'],
+                 'files': [get_file_hash(cache_path, path, file_hashes) for path in stage['files']]}
+
+        # default=repr covers values json can't store, like compiled regex patterns
+        keys[name] = hashlib.sha256(json.dumps(parts, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+    write_file_hashes(cache_path, file_hashes)
+
+    return keys
+
+def get_result_path(cache_path, name, key):
+    return os.path.join(cache_path, name, key + '.pkl')
+
+def read_result(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def write_result(cache_path, name, key, value):
+    path = get_result_path(cache_path, name, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # written aside and swapped in, an interrupted run never leaves a broken result under a valid key
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+    prune_results(os.path.dirname(path))
+
+    return path
+
+def prune_results(folder):
+    paths = sorted((os.path.join(folder, filename) for filename in os.listdir(folder) if filename.endswith('.pkl')),
+                   key=os.path.getmtime, reverse=True)
+
+    for path in paths[keep_versions:]:
+        os.remove(path)
+
+def plan_stages(stages, cache_path, targets=None):
+    # which stages a run of targets needs and which of those are already cached, nothing is loaded
+    stages_by_name = {stage['name']: stage for stage in stages}
+    targets = targets or [stages[-1]['name']]
+
+    os.makedirs(cache_path, exist_ok=True)
+    needed = get_needed_stages(stages_by_name, targets)
+    keys = get_stage_keys(stages_by_name, needed, cache_path)
+
+    return {name: {'key': key, 'cached': os.path.exists(get_result_path(cache_path, name, key))}
+            for name, key in keys.items()}
+
+def run_stages(stages, cache_path, targets=None):
+    stages_by_name = {stage['name']: stage for stage in stages}
+    targets = targets or [stages[-1]['name']]
+    plan = plan_stages(stages, cache_path, targets)
+
+    # results are kept in memory only while a stage still waiting for them needs them
+    consumers = {name: 0 for name in plan}
+    for name in plan:
+        for dep in stages_by_name[name]['deps']:
+            consumers[dep] += 1
+    for name in targets:
+        consumers[name] += 1
+
+    results = {}
+    status = {}
+
+    def get_result(name):
+        stage = stages_by_name[name]
+        key = plan[name]['key']
+
+        # a cached stage is loaded only when something needs it, the stages before it are never touched
+        if plan[name]['cached']:
+            start_time = time.perf_counter()
+            value = read_result(get_result_path(cache_path, name, key))
+            status[name] = 'cached'
+        else:
+            args = [take_result(dep, stage['copy_inputs']) for dep in stage['deps']]
+            start_time = time.perf_counter()
+            value = stage['function'](*args, **stage['params'])
+            write_result(cache_path, name, key, value)
+            status[name] = 'computed'
+
+        print("Stage {} {} in {:.2f} sec".format(name, status[name], time.perf_counter() - start_time))
+
+        return value
+
+    def take_result(name, copy_inputs=True):
+        if name not in results:
+            results[name] = get_result(name)
+
+        consumers[name] -= 1
+        value = results[name]
+
+        # the last consumer gets the result itself, the ones before it a copy they may change freely
+        if consumers[name] == 0:
+            del results[name]
+            return value
+
+        return value.copy() if copy_inputs and hasattr(value, 'copy') else value
+
+    outputs = {name: take_result(name) for name in targets}
+
+    return outputs, status
+
+def clear_cache(cache_path, names=None):
+    # names=None removes every cached result
+    for name in names or [name for name in os.listdir(cache_path) if os.path.isdir(os.path.join(cache_path, name))]:
+        folder = os.path.join(cache_path, name)
+
+        if os.path.isdir(folder):
+            for filename in os.listdir(folder):
+                os.remove(os.path.join(folder, filename))
+            os.rmdir(folder)
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+This file is about to keep tables on disk for the downloading and cleaning scripts.
+
+Tables are stored as .csv files, as parquet datasets partitioned by appid range or in one sqlite database
+with indexes for lookups (see analytics.py). Parquet needs pyarrow installed, csv and sqlite work without it.
+"""
+
+#%% standard library imports
+from ast import literal_eval
+from contextlib import closing
+import json
+import os
+import re
+import shutil
+import sqlite3
+import time
+import uuid
+
+#%% third-party imports
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    ds = None
+    feather = None
+    pq = None
+
+#%% settings
+formats = ['csv', 'parquet', 'sqlite']
+
+# apps per parquet partition, appid 0-9999 goes to appid_range=0, 10000-19999 to appid_range=1 and so on
+partition_size = 10000
+partition_column = 'appid_range'
+
+# raw api fields with a stable type, every other raw field is kept as text like in the csv files
+raw_types = {
+    'steam_appid': 'int64', 'appid': 'int64', 'is_free': 'bool',
+    'positive': 'int64', 'negative': 'int64', 'userscore': 'int64', 'ccu': 'int64',
+    'average_forever': 'int64', 'average_2weeks': 'int64', 'median_forever': 'int64', 'median_2weeks': 'int64'}
+
+# every sqlite table goes to one database file in the table folder
+database_filename = 'steam_data.db'
+
+# sqlite columns indexed when a table has them, search columns get a full text index (fts5) instead
+# id and value are the keys of the dimension and bridge tables (developers, app_developers, ...)
+index_columns = ['steam_appid', 'appid', 'developer', 'publisher', 'release_date', 'id', 'value']
+search_columns = ['name']
+
+#%% functions definition
+def check_format(fmt):
+    if fmt not in formats:
+        raise ValueError("Unknown storage format '{}', use one of {}".format(fmt, formats))
+
+    if fmt == 'parquet' and pq is None:
+        raise ImportError("Parquet storage needs pyarrow, install it or use fmt='csv'")
+
+def get_table_path(folder, name, fmt='csv'):
+    check_format(fmt)
+
+    # parquet tables are directories of partition folders, sqlite tables share one database file
+    if fmt == 'csv':
+        return os.path.join(folder, name + '.csv')
+
+    if fmt == 'sqlite':
+        return os.path.join(folder, database_filename)
+
+    return os.path.join(folder, name)
+
+def table_exists(folder, name, fmt='csv'):
+    path = get_table_path(folder, name, fmt)
+
+    if fmt == 'sqlite' and os.path.exists(path):
+        with closing(connect_database(path)) as con:
+            return sqlite_table_exists(con, name)
+
+    return os.path.exists(path)
+
+def remove_table(folder, name, fmt='csv'):
+    path = get_table_path(folder, name, fmt)
+
+    if fmt == 'sqlite':
+        if os.path.exists(path):
+            with closing(connect_database(path)) as con:
+                drop_sqlite_table(con, name)
+                con.commit()
+    elif os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def get_raw_schema(columns):
+    arrow_types = {'int64': pa.int64(), 'bool': pa.bool_()}
+
+    return pa.schema([(column, arrow_types.get(raw_types.get(column), pa.string())) for column in columns])
+
+def raw_value(value):
+    # nested values are stored as json, same as in the csv files written by the downloader
+    if value is None or isinstance(value, str):
+        return value
+
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+
+    return str(value)
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return literal_eval(value)
+
+def parse_nested(series):
+    # downloader stores nested fields as json, files downloaded before that hold python repr strings
+    try:
+        return series.map(json.loads, na_action='ignore')
+    except ValueError:
+        return series.map(parse_value, na_action='ignore')
+
+def rows_to_table(rows, columns):
+    # one fixed schema for every batch, so batches downloaded separately read back as one dataset
+    schema = get_raw_schema(columns)
+    data = {}
+
+    for field in schema:
+        values = [row.get(field.name) for row in rows]
+
+        if pa.types.is_string(field.type):
+            values = [raw_value(value) for value in values]
+        else:
+            values = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce')
+            values = [None if pd.isnull(value) else value for value in values]
+
+            if pa.types.is_boolean(field.type):
+                values = [None if value is None else bool(value) for value in values]
+            else:
+                values = [None if value is None else int(value) for value in values]
+
+        data[field.name] = pa.array(values, type=field.type)
+
+    return pa.Table.from_pydict(data, schema=schema)
+
+def add_partition_column(table, key):
+    appid_range = pd.to_numeric(table.column(key).to_pandas(), errors='coerce').fillna(0) // partition_size
+
+    return table.append_column(partition_column, pa.array(appid_range.astype('int64')))
+
+def write_rows(rows, folder, name, columns, key, batch_id, fmt='csv'):
+    check_format(fmt)
+
+    if fmt == 'csv':
+        raise ValueError("Raw csv rows are appended by the downloader itself")
+
+    table = add_partition_column(rows_to_table(rows, columns), key)
+
+    # batch id in the file name makes a repeated batch overwrite its files instead of adding rows twice
+    pq.write_to_dataset(table, get_table_path(folder, name, fmt), partition_cols=[partition_column],
+                        basename_template='batch-{}-{{i}}.parquet'.format(batch_id),
+                        existing_data_behavior='overwrite_or_ignore', compression='zstd')
+
+def remove_batches(folder, name, first_batch, fmt='parquet'):
+    # files of batch first_batch and later, written by write_rows but never committed to the journal
+    path = get_table_path(folder, name, fmt)
+
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            match = re.match(r'batch-(\d+)-', filename)
+            if match and int(match.group(1)) >= first_batch:
+                os.remove(os.path.join(root, filename))
+
+def write_table(df, folder, name, fmt='csv', key=None, append=False):
+    path = get_table_path(folder, name, fmt)
+
+    # append adds rows to a table written before, used when data is processed in chunks
+    if fmt == 'csv':
+        df.to_csv(path, index=False, mode='a' if append else 'w', header=not append)
+        return path
+
+    if not append:
+        remove_table(folder, name, fmt)
+
+    # parquet and sqlite have no sparse type, one-hot columns are stored dense and left to compression
+    sparse_columns = [column for column in df.columns if isinstance(df[column].dtype, pd.SparseDtype)]
+    if sparse_columns:
+        df = df.astype({column: df[column].dtype.subtype for column in sparse_columns})
+
+    if fmt == 'sqlite':
+        write_sqlite_table(df, path, name)
+        return path
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    # file names start with the write time, appended chunks are read back in the order they were written
+    if key is None:
+        os.makedirs(path, exist_ok=True)
+        pq.write_table(table, os.path.join(path, 'part-{}-{}.parquet'.format(time.time_ns(), uuid.uuid4().hex)),
+                       compression='zstd')
+    else:
+        table = add_partition_column(table, key)
+        pq.write_to_dataset(table, path, partition_cols=[partition_column], compression='zstd',
+                            basename_template='part-{}-{{i}}.parquet'.format(time.time_ns()))
+
+    return path
+
+def read_table(folder, name, fmt='csv', columns=None, **kwargs):
+    path = get_table_path(folder, name, fmt)
+
+    if fmt == 'csv':
+        return pd.read_csv(path, usecols=columns, **kwargs)
+
+    if fmt == 'sqlite':
+        with closing(connect_database(path)) as con:
+            return pd.read_sql_query(get_select_query(name, columns), con, **kwargs)
+
+    # only requested columns are read from disk, partition column is an implementation detail
+    table = get_dataset(path).to_table(columns=columns, **kwargs)
+
+    return table_to_frame(table)
+
+def iter_table(folder, name, fmt='csv', chunksize=50000, columns=None, **kwargs):
+    path = get_table_path(folder, name, fmt)
+
+    if fmt == 'csv':
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunksize, **kwargs)
+        return
+
+    if fmt == 'sqlite':
+        with closing(connect_database(path)) as con:
+            yield from pd.read_sql_query(get_select_query(name, columns), con, chunksize=chunksize, **kwargs)
+        return
+
+    dataset = get_dataset(path)
+
+    for batch in dataset.to_batches(columns=columns, batch_size=chunksize, **kwargs):
+        yield table_to_frame(pa.Table.from_batches([batch]))
+
+#%% sqlite tables
+def connect_database(path):
+    # side tables are written from several threads, a writer waits for the others instead of failing
+    return sqlite3.connect(path, timeout=60)
+
+def quote_name(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+def get_select_query(name, columns=None):
+    selected = ', '.join(quote_name(column) for column in columns) if columns else '*'
+
+    return 'SELECT {} FROM {}'.format(selected, quote_name(name))
+
+def sqlite_table_exists(con, name):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", (name,)).fetchone() is not None
+
+def drop_sqlite_table(con, name):
+    con.execute('DROP TABLE IF EXISTS {}'.format(quote_name(name + '_fts')))
+    con.execute('DROP TABLE IF EXISTS {}'.format(quote_name(name)))
+
+def write_sqlite_table(df, path, name):
+    # categoricals are written as their values, sqlite has no type for them
+    category_columns = [column for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)]
+    if category_columns:
+        df = df.astype({column: object for column in category_columns})
+
+    with closing(connect_database(path)) as con:
+        # rows appended to an existing table are added to its search index, the rest is not indexed again
+        last_rowid = 0
+        if sqlite_table_exists(con, name):
+            last_rowid = con.execute('SELECT coalesce(max(rowid), 0) FROM {}'.format(quote_name(name))).fetchone()[0]
+
+        df.to_sql(name, con, if_exists='append', index=False, chunksize=50000)
+        create_indexes(con, name, df.columns, last_rowid)
+        con.commit()
+
+def create_indexes(con, name, columns, last_rowid=0):
+    for column in index_columns:
+        if column in columns:
+            con.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                quote_name('{}_{}'.format(name, column)), quote_name(name), quote_name(column)))
+
+    for column in search_columns:
+        if column not in columns:
+            continue
+
+        if last_rowid and sqlite_table_exists(con, name + '_fts'):
+            con.execute('INSERT INTO {0}(rowid, {1}) SELECT rowid, {1} FROM {2} WHERE rowid > ?'.format(
+                quote_name(name + '_fts'), quote_name(column), quote_name(name)), (last_rowid,))
+        else:
+            create_search_index(con, name, column)
+
+def create_search_index(con, name, column):
+    # external content table: fts5 keeps only the inverted index and reads text from the table by rowid
+    fts_name = name + '_fts'
+
+    try:
+        con.execute('DROP TABLE IF EXISTS {}'.format(quote_name(fts_name)))
+        con.execute("CREATE VIRTUAL TABLE {} USING fts5({}, content='{}', content_rowid='rowid')".format(
+            quote_name(fts_name), quote_name(column), name.replace("'", "''")))
+        con.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(quote_name(fts_name)))
+    except sqlite3.OperationalError as error:
+        # sqlite built without fts5, name search falls back to LIKE
+        print("No full text index for {}: {}".format(name, error))
+
+#%% arrow ipc files
+def write_frame_ipc(df, path):
+    # uncompressed arrow ipc file, other processes map it into memory instead of unpickling a copy
+    check_format('parquet')
+    feather.write_feather(pa.Table.from_pandas(df), path, compression='uncompressed')
+
+def read_frame_ipc(path):
+    check_format('parquet')
+
+    return table_to_frame(feather.read_table(path, memory_map=True))
+
+def get_file_order(path):
+    # numbers in the path compared as numbers, appid_range=2 comes before appid_range=10, batch-20 before batch-100
+    return [int(number) for number in re.findall(r'\d+', path)]
+
+def get_dataset(path):
+    # partition values are ints and files are read in appid range and batch order, so rows keep their key order
+    partitioning = ds.partitioning(pa.schema([(partition_column, pa.int64())]), flavor='hive')
+    files = sorted(ds.dataset(path, format='parquet', partitioning=partitioning).files,
+                   key=lambda file: get_file_order(os.path.relpath(file, path)))
+
+    return ds.dataset(files, format='parquet', partitioning=partitioning, partition_base_dir=path)
+
+def table_to_frame(table):
+    if partition_column in table.column_names:
+        table = table.drop([partition_column])
+
+    # missing text comes back as None, cleaning code expects NaN the way read_csv returns it
+    df = table.to_pandas()
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].where(df[column].notnull(), np.nan)
+
+    return df
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+This file is about to check that the vectorized cleaning gives the same output as the row by row one.
+
+Synthetic store data from benchmark.py is cleaned by both engines, in the python repr the first downloads
+were written with and in the json the downloader writes now. Run with python -m pytest test_cleaning.py
+"""
+
+#%% standard library imports
+import os
+
+#%% third-party imports
+import pandas as pd
+import pytest
+
+#%% local imports
+import benchmark
+
+#%% settings
+# enough rows for every price, date and requirements shape the generator makes, and some duplicates
+test_rows = 500
+
+#%% tests
+@pytest.mark.parametrize('encoding', ['repr', 'json'])
+def test_check_vectorized(tmp_path, encoding):
+    downloader = benchmark.load_script(benchmark.downloader_script, 'steam_downloader')
+    cleaning = benchmark.load_script(benchmark.cleaning_script, 'steam_cleaning')
+
+    data_file = benchmark.write_synthetic_data(os.path.join(tmp_path, 'steam_app_data.csv'), benchmark.make_steam_row,
+                                               downloader.steam_columns, test_rows, encoding)
+
+    cleaning.check_vectorized(pd.read_csv(data_file))
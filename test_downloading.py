@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+This file is about to check that an interrupted download resumes with every app written exactly once.
+
+The downloader runs against the stub server from benchmark.py, a crash is simulated by raising from a
+checkpoint or a request in the middle of a run. Run with python -m pytest test_downloading.py
+"""
+
+#%% third-party imports
+import pandas as pd
+import pytest
+
+#%% local imports
+import benchmark
+import storage
+
+#%% settings
+data_filename = 'steamspy_data.csv'
+journal_filename = 'steamspy_journal.jsonl'
+batchsize = 10
+
+#%% helpers
+class Crash(Exception):
+    pass
+
+@pytest.fixture(scope='module')
+def server():
+    server = benchmark.start_stub_server()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def downloader(server, monkeypatch):
+    downloader = benchmark.load_script(benchmark.downloader_script, 'steam_downloader')
+    host, port = server.server_address
+    monkeypatch.setattr(downloader, 'STEAMSPY_URL', 'http://{}:{}/api.php'.format(host, port))
+
+    return downloader
+
+def crash_on_checkpoint(downloader, monkeypatch, call, committed=False):
+    # the batch is written but the process dies before its checkpoint is committed, or right after it
+    append_checkpoint = downloader.append_checkpoint
+    calls = []
+
+    def crashing(*args):
+        calls.append(args)
+        if len(calls) == call and not committed:
+            raise Crash()
+        append_checkpoint(*args)
+        if len(calls) == call:
+            raise Crash()
+
+    monkeypatch.setattr(downloader, 'append_checkpoint', crashing)
+
+def crashing_parser(parser, calls):
+    # the process dies in the middle of a batch, after some of its requests
+    done = []
+
+    def parse(appid, name):
+        if len(done) == calls:
+            raise Crash()
+        done.append(appid)
+        return parser(appid, name)
+
+    return parse
+
+def run_download(downloader, app_list, download_path, storage_format='csv', parser=None):
+    # same calls as __main__ of the downloader
+    index = downloader.get_index(download_path, journal_filename)
+    downloader.prepare_data_file(download_path, data_filename, index, downloader.steamspy_columns, storage_format)
+    downloader.process_batches(parser=parser or downloader.parse_steamspy_request, app_list=app_list, download_path=download_path,
+                               data_filename=data_filename, journal_filename=journal_filename,
+                               columns=downloader.steamspy_columns, batchsize=batchsize, pause=0,
+                               storage_format=storage_format)
+
+def run_refresh(downloader, changed_apps, download_path):
+    downloader.refresh_apps(parser=downloader.parse_steamspy_request, changed_apps=changed_apps,
+                            download_path=download_path, data_filename=data_filename,
+                            journal_filename=journal_filename, columns=downloader.steamspy_columns, key='appid',
+                            batchsize=batchsize, pause=0)
+
+def read_appids(download_path, storage_format='csv'):
+    data = storage.read_table(download_path, 'steamspy_data', fmt=storage_format)
+
+    return pd.to_numeric(data['appid']).tolist()
+
+#%% tests
+@pytest.mark.parametrize('storage_format', ['csv', 'parquet'])
+def test_resume_mid_batch(tmp_path, downloader, storage_format):
+    if storage_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    app_list = benchmark.make_app_list(40)
+
+    with pytest.raises(Crash):
+        run_download(downloader, app_list, tmp_path, storage_format,
+                     parser=crashing_parser(downloader.parse_steamspy_request, 25))
+
+    run_download(downloader, app_list, tmp_path, storage_format)
+
+    assert read_appids(tmp_path, storage_format) == app_list['appid'].tolist()
+
+def test_resume_torn_tail(tmp_path, downloader, monkeypatch):
+    app_list = benchmark.make_app_list(40)
+
+    # third batch written without its checkpoint, then a row and a checkpoint torn in half by the crash
+    with monkeypatch.context() as patch:
+        crash_on_checkpoint(downloader, patch, 3)
+        with pytest.raises(Crash):
+            run_download(downloader, app_list, tmp_path)
+
+    with open(tmp_path / data_filename, 'ab') as f:
+        f.write(b'999,"Broken na')
+    with open(tmp_path / journal_filename, 'ab') as f:
+        f.write(b'{"index": 30, "ro')
+
+    run_download(downloader, app_list, tmp_path)
+
+    assert read_appids(tmp_path) == app_list['appid'].tolist()
+
+def test_resume_rebuilt_app_list(tmp_path, downloader):
+    app_list = benchmark.make_app_list(40)
+    run_download(downloader, app_list.iloc[:20], tmp_path)
+
+    # new apps shift the positions of the apps after them, resume goes by appid
+    new_apps = pd.DataFrame({'appid': [15, 35, 405], 'name': ['New 15', 'New 35', 'New 405']})
+    rebuilt = pd.concat([app_list, new_apps]).sort_values('appid').reset_index(drop=True)
+    run_download(downloader, rebuilt, tmp_path)
+
+    appids = read_appids(tmp_path)
+    assert sorted(appids) == rebuilt['appid'].tolist()
+    assert len(appids) == len(set(appids))
+
+def test_shard_merge_order(tmp_path, downloader):
+    app_list = benchmark.make_app_list(40)
+
+    downloader.process_shards(downloader.parse_steamspy_request, app_list, tmp_path, data_filename, journal_filename,
+                              downloader.steamspy_columns, workers=3, batchsize=batchsize, pause=0)
+
+    assert read_appids(tmp_path) == app_list['appid'].tolist()
+
+def test_resume_parquet(tmp_path, downloader, monkeypatch):
+    pytest.importorskip('pyarrow')
+    app_list = benchmark.make_app_list(40)
+
+    # two batches committed, the third written to disk without its checkpoint
+    with monkeypatch.context() as patch:
+        crash_on_checkpoint(downloader, patch, 3)
+        with pytest.raises(Crash):
+            run_download(downloader, app_list, tmp_path, 'parquet')
+
+    run_download(downloader, app_list, tmp_path, 'parquet')
+
+    assert read_appids(tmp_path, 'parquet') == app_list['appid'].tolist()
+
+def test_refresh_resume(tmp_path, downloader, monkeypatch):
+    app_list = benchmark.make_app_list(40)
+    run_download(downloader, app_list.iloc[:30], tmp_path)
+
+    # 5 stored apps changed and 10 new ones, two update batches and the upsert checkpoint
+    changed_apps = app_list.iloc[25:].reset_index(drop=True)
+
+    # dies after the upsert checkpoint, before the rewritten file is swapped in
+    with monkeypatch.context() as patch:
+        crash_on_checkpoint(downloader, patch, 3, committed=True)
+        with pytest.raises(Crash):
+            run_refresh(downloader, changed_apps, tmp_path)
+
+    # a normal resume finishes the upsert instead of truncating the file, then the refresh is run again
+    run_download(downloader, app_list, tmp_path)
+    run_refresh(downloader, changed_apps, tmp_path)
+
+    assert read_appids(tmp_path) == app_list['appid'].tolist()
+
+def test_shards_rebuilt_app_list(tmp_path, downloader):
+    app_list = benchmark.make_app_list(40)
+    run_shards = lambda apps: downloader.process_shards(downloader.parse_steamspy_request, apps, tmp_path, data_filename,
+                                                        journal_filename, downloader.steamspy_columns, workers=3,
+                                                        batchsize=batchsize, pause=0)
+    run_shards(app_list.iloc[:30])
+
+    # new apps move the positions of the old ones, every app stays in the shard that has it in its journal
+    new_apps = pd.DataFrame({'appid': [15, 135, 405], 'name': ['New 15', 'New 135', 'New 405']})
+    run_shards(pd.concat([app_list, new_apps]).sort_values('appid').reset_index(drop=True))
+
+    appids = read_appids(tmp_path)
+    assert sorted(appids) == sorted(app_list['appid'].tolist() + [15, 135, 405])
+    assert len(appids) == len(set(appids))